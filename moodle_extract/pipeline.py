@@ -1,55 +1,669 @@
 """Template for newly generated pipelines."""
 
+import gzip
+import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
+from threading import Lock
+from typing import Callable, Iterator
+from urllib.parse import quote_plus
 
 import polars as pl
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from openhexa.sdk import current_run, parameter, pipeline, workspace
 from openhexa.sdk.utils import Environment, get_environment
-from queries import QUERIES
+from profiling import profile_query
+from queries import QUERIES, TABLES, build_query, render_query
+from sqlalchemy import Engine, TextClause, create_engine, text
+
+# rows modified shortly before the previous extraction may have been committed after
+# it: always re-fetch this many seconds before the stored high-water mark
+WATERMARK_LOOKBACK = 3600
+
+PARQUET_COMPRESSION = "zstd"
+
+# function running a table query and returning its results
+Reader = Callable[[TextClause], pl.DataFrame]
 
 
 @pipeline("moodle-extract", name="Extract Moodle data")
-@parameter("output_dir", name="Output directory", type=str, default="moodle/data/raw")
-def moodle_extract(output_dir: str):
+@parameter(
+    "output_dir",
+    name="Output directory",
+    help="Directory of the extracted tables (files are only rewritten when their content changed)",
+    type=str,
+    default="moodle/data/raw",
+)
+@parameter(
+    "incremental",
+    name="Incremental extraction",
+    help="Only fetch rows modified since the previous run for tables that support it",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "max_workers",
+    name="Max concurrency",
+    help="Maximum number of tables extracted at the same time (database connections)",
+    type=int,
+    default=6,
+)
+@parameter(
+    "batch_size",
+    name="Batch size",
+    help="Number of rows fetched and written at a time for large tables, bounding memory usage (0 for all rows)",
+    type=int,
+    default=100000,
+)
+@parameter(
+    "csv_output",
+    name="CSV output",
+    help="Also write tables as CSV files, optionally gzip-compressed (none to only write them on demand with CSV export)",
+    type=str,
+    choices=["none", "plain", "gzip"],
+    default="plain",
+)
+@parameter(
+    "row_group_size",
+    name="Parquet row group size",
+    help="Maximum number of rows per row group in parquet files",
+    type=int,
+    default=100000,
+)
+@parameter(
+    "partition",
+    name="Partition by year",
+    help="Also write tables with a date column as parquet datasets partitioned by year",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "tables",
+    name="Tables",
+    type=str,
+    multiple=True,
+    choices=list(QUERIES),
+    default=list(QUERIES),
+)
+@parameter(
+    "modified_since",
+    name="Modified since",
+    help="Only fetch rows modified on or after this date (YYYY-MM-DD) and merge them into existing data",
+    type=str,
+    required=False,
+)
+@parameter(
+    "modified_until",
+    name="Modified until",
+    help="Only fetch rows modified before this date (YYYY-MM-DD) and merge them into existing data",
+    type=str,
+    required=False,
+)
+@parameter(
+    "org_units",
+    name="Org units",
+    help="Only fetch rows of users belonging to these cohorts and merge them into existing data",
+    type=str,
+    multiple=True,
+    required=False,
+)
+@parameter(
+    "profile",
+    name="Profile queries",
+    help="Profile extraction queries (execution plans, timings, index suggestions) instead of extracting data",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "export_csv",
+    name="Export CSV",
+    help="Write missing or outdated CSV copies of the selected tables from their parquet files instead of extracting data",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "consistent_snapshot",
+    name="Consistent snapshot",
+    help="Read all tables from a single database transaction, consistent with each other but one query at a time",
+    type=bool,
+    default=False,
+)
+def moodle_extract(
+    output_dir: str,
+    incremental: bool,
+    max_workers: int,
+    batch_size: int,
+    csv_output: str,
+    row_group_size: int,
+    partition: bool,
+    tables: list[str],
+    modified_since: str | None,
+    modified_until: str | None,
+    org_units: list[str] | None,
+    profile: bool,
+    export_csv: bool,
+    consistent_snapshot: bool,
+):
     """Write your pipeline orchestration here.
 
     Pipeline functions should only call tasks and should never perform IO operations or expensive computations.
     """
     con = workspace.custom_connection("moodle-database")
-    db = f"mysql://{con.username}:{con.password}@{con.host}:{con.port}/{con.dbname}"
+    db = f"mysql://{con.username}:{quote_plus(con.password)}@{con.host}:{con.port}/{con.dbname}"
     current_run.log_info(f"Connected to database {con.host}/{con.dbname} with user {con.username}")
     output_dir = Path(workspace.files_path, Path(output_dir))
     os.makedirs(output_dir, exist_ok=True)
 
-    download(db, output_dir)
+    if profile:
+        profile_queries(db, output_dir, tables=tables)
+        return
+
+    if export_csv:
+        export_tables(output_dir, tables=tables, compression="gzip" if csv_output == "gzip" else "plain")
+        return
+
+    download(
+        db,
+        output_dir,
+        incremental=incremental,
+        max_workers=max_workers,
+        batch_size=batch_size,
+        csv_output=csv_output,
+        row_group_size=row_group_size,
+        partition=partition,
+        tables=tables,
+        modified_since=modified_since,
+        modified_until=modified_until,
+        org_units=org_units,
+        consistent_snapshot=consistent_snapshot,
+    )
+
+
+def to_timestamp(date: str) -> int:
+    """Convert a YYYY-MM-DD date to a unix timestamp."""
+    return int(datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+
+
+def read_watermark(fp: Path) -> int | None:
+    """Read the high-water mark (unix timestamp) stored for a table."""
+    if not fp.exists():
+        return None
+    with open(fp) as f:
+        return json.load(f)["value"]
+
+
+def write_watermark(fp: Path, column: str, value: int):
+    """Store the high-water mark (unix timestamp) of a table next to its output."""
+    with open(fp, "w") as f:
+        json.dump({"column": column, "value": value}, f)
+
+
+def create_session_engine(db: str) -> Engine:
+    """Create a single-connection SQLAlchemy engine, for modes that need a database session."""
+    return create_engine(
+        db.replace("mysql://", "mysql+pymysql://", 1),
+        pool_size=1,
+        max_overflow=0,
+        pool_pre_ping=True,
+    )
+
+
+def read_table(read: Reader, name: str, query: TextClause) -> pl.DataFrame:
+    """Read the results of a table query, with timestamps converted to UTC datetimes."""
+    timestamps = TABLES[name].get("timestamps", [])
+    df = read(query)
+    return df.with_columns(
+        [pl.col(column).cast(dtype) for column, dtype in TABLES[name].get("dtypes", {}).items()]
+        + [pl.from_epoch(pl.col(column).cast(pl.Int64), time_unit="s") for column in timestamps]
+    )
+
+
+def read_batches(
+    read: Reader, name: str, batch_size: int, **filters
+) -> Iterator[pl.DataFrame]:
+    """Read table rows in batches using keyset pagination on the primary key."""
+    key = TABLES[name]["key"][0]
+    last = None
+    while True:
+        query = build_query(name, after=last, limit=batch_size, **filters)
+        df = read_table(read, name, query)
+        if df.is_empty() and last is not None:
+            break
+        yield df
+        if len(df) < batch_size:
+            break
+        last = df[key].max()
+
+
+def write_batches(
+    batches: Iterator[pl.DataFrame], dst_file: Path, row_group_size: int | None = None
+) -> int:
+    """Write batches of rows to a parquet file and return the number of rows written."""
+    writer = None
+    n = 0
+    try:
+        for df in batches:
+            table = df.to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(dst_file, table.schema, compression=PARQUET_COMPRESSION)
+            writer.write_table(table.cast(writer.schema), row_group_size=row_group_size)
+            n += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
+
+
+def write_csv(src_file: Path, dst_file: Path, compression: str = "plain"):
+    """Write a CSV copy of a parquet file, optionally gzip-compressed."""
+    if compression == "gzip":
+        pf = pq.ParquetFile(src_file)
+        with gzip.open(dst_file, "wb") as f:
+            # header is written from the schema so that empty tables still have one
+            pl.from_arrow(pf.schema_arrow.empty_table()).write_csv(f)
+            for batch in pf.iter_batches():
+                pl.from_arrow(batch).write_csv(f, include_header=False)
+    else:
+        pl.scan_parquet(src_file).sink_csv(dst_file)
+
+
+def write_partitions(src_file: Path, dst_dir: Path, column: str):
+    """Write a copy of a parquet file as a hive-style dataset partitioned by year of a date column."""
+    dataset = ds.dataset(src_file, format="parquet")
+    columns = {name: ds.field(name) for name in dataset.schema.names}
+    columns["year"] = pc.year(ds.field(column))
+
+    if dst_dir.exists():
+        shutil.rmtree(dst_dir)
+
+    ds.write_dataset(
+        dataset.scanner(columns=columns),
+        dst_dir,
+        format="parquet",
+        partitioning=["year"],
+        partitioning_flavor="hive",
+        file_options=ds.ParquetFileFormat().make_write_options(compression=PARQUET_COMPRESSION),
+    )
+
+
+def fingerprint(fp: Path) -> str:
+    """Compute an order-independent content hash of a parquet file."""
+    # row hashes are summed by halves so that the computation can be streamed, hashes
+    # are only comparable between runs using the same version of polars
+    h = pl.struct(pl.all()).hash(seed=0)
+    sums = (
+        pl.scan_parquet(fp)
+        .select(
+            (h % 2**32).sum().alias("lo"),
+            (h // 2**32).sum().alias("hi"),
+        )
+        .collect()
+        .row(0)
+    )
+    return "".join(f"{(v or 0) & (2**64 - 1):016x}" for v in sums)
+
+
+def column_bounds(meta: pq.FileMetaData, column: str) -> tuple:
+    """Get min and max values of a column from parquet row groups statistics."""
+    i = meta.schema.names.index(column)
+    mins, maxs = [], []
+    for rg in range(meta.num_row_groups):
+        stats = meta.row_group(rg).column(i).statistics
+        if stats is None:
+            return None, None
+        # row groups with only null values have no min/max
+        if not stats.has_min_max:
+            continue
+        mins.append(stats.min)
+        maxs.append(stats.max)
+    if not mins:
+        return None, None
+    return min(mins), max(maxs)
+
+
+def build_manifest(fp: Path) -> dict:
+    """Describe a parquet file (rows, schema, temporal bounds, content hash)."""
+    meta = pq.read_metadata(fp)
+    schema = pl.read_parquet_schema(fp)
+
+    bounds = {}
+    for column, dtype in schema.items():
+        if dtype.is_temporal():
+            vmin, vmax = column_bounds(meta, column)
+            bounds[column] = {
+                "min": vmin.isoformat() if vmin is not None else None,
+                "max": vmax.isoformat() if vmax is not None else None,
+            }
+
+    return {
+        "rows": meta.num_rows,
+        "schema": {column: str(dtype) for column, dtype in schema.items()},
+        "bounds": bounds,
+        "hash": fingerprint(fp),
+        "polars_version": pl.__version__,
+        "updated_at": datetime.now().isoformat(),
+    }
+
+
+def read_manifest(fp: Path) -> dict | None:
+    """Read the manifest of a table."""
+    if not fp.exists():
+        return None
+    with open(fp) as f:
+        return json.load(f)
+
+
+def write_manifest(fp: Path, manifest: dict):
+    """Write the manifest of a table next to its output."""
+    with open(fp, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def is_unchanged(manifest_old: dict | None, manifest_new: dict) -> bool:
+    """Check if two table manifests describe the same content."""
+    if not manifest_old or "hash" not in manifest_old:
+        return False
+    return (
+        manifest_old["polars_version"] == manifest_new["polars_version"]
+        and manifest_old["rows"] == manifest_new["rows"]
+        and manifest_old["schema"] == manifest_new["schema"]
+        and manifest_old["hash"] == manifest_new["hash"]
+    )
+
+
+def check_schema(name: str, old: dict, new: dict):
+    """Warn about columns added, removed or whose type changed between two versions."""
+    for column in old.keys() - new.keys():
+        current_run.log_warning(f"Column `{column}` has been removed from {name} data")
+    for column in new.keys() - old.keys():
+        current_run.log_info(f"Column `{column}` has been added to {name} data")
+    for column in old.keys() & new.keys():
+        if old[column] != new[column]:
+            current_run.log_warning(
+                f"Type of column `{column}` in {name} data changed from {old[column]} to {new[column]}"
+            )
+
+
+def merge(df_old: pl.LazyFrame, df_new: pl.LazyFrame, key: list[str]) -> pl.LazyFrame:
+    """Merge new rows into an existing dataset, new rows replacing old ones by key."""
+    return pl.concat(
+        [df_old.join(df_new.select(key), on=key, how="anti"), df_new],
+        how="vertical_relaxed",
+    )
+
+
+def extract(
+    read: Reader,
+    name: str,
+    dst_dir: Path,
+    incremental: bool = False,
+    batch_size: int = 0,
+    csv_output: str = "plain",
+    row_group_size: int | None = None,
+    partition: bool = False,
+    modified_since: int | None = None,
+    modified_until: int | None = None,
+    org_units: list[str] | None = None,
+    snapshot_at: int | None = None,
+) -> list[Path]:
+    """Extract a Moodle table with the given reader and return the list of files written."""
+    table = TABLES[name]
+    dst_file_pqt = Path(dst_dir, f"{name}.parquet")
+    dst_file_csv = Path(dst_dir, f"{name}.csv.gz" if csv_output == "gzip" else f"{name}.csv")
+    dst_dir_partitions = Path(dst_dir, name)
+    dst_file_watermark = Path(dst_dir, f"{name}.watermark.json")
+    dst_file_manifest = Path(dst_dir, f"{name}.manifest.json")
+    tmp_file_pqt = Path(dst_dir, f"{name}.parquet.tmp")
+
+    # compare with previous version using its manifest, or parquet footer metadata if
+    # the manifest is missing
+    manifest_old = read_manifest(dst_file_manifest)
+    if manifest_old is None and dst_file_pqt.exists():
+        manifest_old = {
+            "rows": pq.read_metadata(dst_file_pqt).num_rows,
+            "schema": {c: str(t) for c, t in pl.read_parquet_schema(dst_file_pqt).items()},
+        }
+    len_old = manifest_old["rows"] if manifest_old else 0
+
+    filters = {}
+    if "watermark" in table:
+        filters["since"] = modified_since
+        filters["until"] = modified_until
+    if "user" in table:
+        filters["org_units"] = org_units
+    filters = {k: v for k, v in filters.items() if v}
+
+    # a partial extraction (filtered or incremental) is merged into the existing dataset
+    # and does not move the high-water mark forward if filtered
+    partial = bool(filters) and len_old > 0
+    update_watermark = "watermark" in table and not filters
+
+    if "watermark" in table:
+        # server time at the start of the extraction, used as next high-water mark
+        if snapshot_at is not None:
+            now = snapshot_at
+        else:
+            now = int(read(text("SELECT UNIX_TIMESTAMP() AS now"))["now"][0])
+        if incremental and len_old and not filters:
+            since = read_watermark(dst_file_watermark)
+            if since is not None:
+                filters["since"] = since - WATERMARK_LOOKBACK
+                partial = True
+
+    if not partial and "batch_key" in table and batch_size:
+        batches = read_batches(read, name, batch_size=batch_size, **filters)
+        write_batches(batches, tmp_file_pqt, row_group_size=row_group_size)
+        df = None
+    else:
+        df = read_table(read, name, build_query(name, **filters))
+
+    # outputs expected in addition to the parquet file
+    outputs = []
+    if csv_output != "none":
+        outputs.append(dst_file_csv)
+    if partition and "partition" in table:
+        outputs.append(dst_dir_partitions)
+    outputs_exist = all(fp.exists() for fp in outputs)
+
+    if partial:
+        current_run.log_info(f"Loaded {len(df)} new or modified {name} rows")
+        if df.is_empty() and outputs_exist:
+            current_run.log_info(f"No change detected in {name} data, skipping")
+            if update_watermark:
+                write_watermark(dst_file_watermark, table["watermark"], now)
+            return []
+        # stream the existing dataset instead of loading it in memory
+        merge(pl.scan_parquet(dst_file_pqt), df.lazy(), key=table["key"]).sink_parquet(
+            tmp_file_pqt, compression=PARQUET_COMPRESSION, row_group_size=row_group_size
+        )
+        df = None
+
+    if df is not None:
+        df.write_parquet(tmp_file_pqt, compression=PARQUET_COMPRESSION, row_group_size=row_group_size)
+        del df
+
+    manifest = build_manifest(tmp_file_pqt)
+    if snapshot_at is not None:
+        manifest["snapshot_at"] = datetime.fromtimestamp(snapshot_at, timezone.utc).isoformat()
+
+    # do not rewrite outputs if content is the same as in the previous run
+    if is_unchanged(manifest_old, manifest) and outputs_exist:
+        current_run.log_info(f"No change detected in {name} data ({manifest['rows']} rows), skipping")
+        os.remove(tmp_file_pqt)
+        if snapshot_at is not None:
+            write_manifest(dst_file_manifest, {**manifest_old, "snapshot_at": manifest["snapshot_at"]})
+        if update_watermark:
+            write_watermark(dst_file_watermark, table["watermark"], now)
+        return []
+
+    os.replace(tmp_file_pqt, dst_file_pqt)
+    current_run.log_info(f"Loaded up-to-date {name} data ({manifest['rows']} rows)")
+
+    if manifest["rows"] < len_old:
+        current_run.log_warning(f"New version of file {name}.parquet has less rows than previous one")
+    if manifest_old:
+        check_schema(name, manifest_old["schema"], manifest["schema"])
+
+    if csv_output != "none":
+        write_csv(dst_file_pqt, dst_file_csv, compression=csv_output)
+    if partition and "partition" in table:
+        write_partitions(dst_file_pqt, dst_dir_partitions, table["partition"])
+
+    if update_watermark:
+        write_watermark(dst_file_watermark, table["watermark"], now)
+    write_manifest(dst_file_manifest, manifest)
+
+    return [dst_file_pqt] + outputs
 
 
 @moodle_extract.task
-def download(db: str, dst_dir: Path):
+def download(
+    db: str,
+    dst_dir: Path,
+    incremental: bool = False,
+    max_workers: int = 6,
+    batch_size: int = 0,
+    csv_output: str = "plain",
+    row_group_size: int | None = None,
+    partition: bool = False,
+    tables: list[str] | None = None,
+    modified_since: str | None = None,
+    modified_until: str | None = None,
+    org_units: list[str] | None = None,
+    consistent_snapshot: bool = False,
+):
     """Get data from the Moodle database."""
-    for name in ("users", "courses", "grades", "enrollments", "certificates", "completions"):
-        dst_file_pqt = Path(dst_dir, f"{name}.parquet")
-        dst_file_csv = Path(dst_dir, f"{name}.csv")
+    names = tables or list(QUERIES)
+    if modified_since or modified_until:
+        unfiltered = [name for name in names if "watermark" not in TABLES[name]]
+        if unfiltered:
+            current_run.log_warning(
+                f"Modification window not applied to tables without a modification date: "
+                f"{', '.join(unfiltered)}"
+            )
+
+    engine = None
+    snapshot = None
+    snapshot_at = None
+    try:
+        if consistent_snapshot:
+            engine = create_session_engine(db)
+            snapshot = engine.connect()
+            snapshot.execution_options(isolation_level="REPEATABLE READ")
+            snapshot.exec_driver_sql("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            snapshot_at = snapshot.execute(text("SELECT UNIX_TIMESTAMP()")).scalar()
+            current_run.log_info(
+                f"Reading Moodle data from consistent snapshot taken at "
+                f"{datetime.fromtimestamp(snapshot_at, timezone.utc).isoformat()}"
+            )
+            # MySQL snapshots cannot be shared between connections: queries are serialized
+            # on the snapshot connection, tables already read are still written concurrently
+            lock = Lock()
+
+            def read(query: TextClause) -> pl.DataFrame:
+                with lock:
+                    return pl.read_database(query=query, connection=snapshot)
 
-        if dst_file_pqt.exists():
-            df_old = pl.read_parquet(dst_file_pqt)
-            len_old = len(df_old)
         else:
-            len_old = 0
+            # queries are read as Arrow data by connectorx, each on its own connection
+            def read(query: TextClause) -> pl.DataFrame:
+                return pl.read_database_uri(query=render_query(query), uri=db, engine="connectorx")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(
+                    extract,
+                    read,
+                    name,
+                    dst_dir,
+                    incremental=incremental,
+                    batch_size=batch_size,
+                    csv_output=csv_output,
+                    row_group_size=row_group_size,
+                    partition=partition,
+                    modified_since=to_timestamp(modified_since) if modified_since else None,
+                    modified_until=to_timestamp(modified_until) if modified_until else None,
+                    org_units=org_units,
+                    snapshot_at=snapshot_at,
+                )
+                for name in names
+            }
+            outputs = {}
+            for name, future in futures.items():
+                outputs[name] = future.result()
+    finally:
+        if snapshot is not None:
+            snapshot.rollback()
+            snapshot.close()
+        if engine is not None:
+            engine.dispose()
 
-        df = pl.read_database_uri(query=QUERIES[name], uri=db)
-        current_run.log_info(f"Loaded up-to-date {name} data ({len(df)} rows)")
+    if get_environment() == Environment.CLOUD_PIPELINE:
+        for name in names:
+            for fp in outputs[name]:
+                current_run.add_file_output(fp.as_posix())
+
+    return True
 
-        if len(df) < len_old:
-            current_run.log_warning(f"New version of file {name}.parquet has less rows than previous one")
 
-        df.write_parquet(dst_file_pqt)
-        df.write_csv(dst_file_csv)
+@moodle_extract.task
+def export_tables(dst_dir: Path, tables: list[str] | None = None, compression: str = "plain"):
+    """Write CSV copies of extracted tables, if missing or older than the parquet files."""
+    for name in tables or list(QUERIES):
+        src_file = Path(dst_dir, f"{name}.parquet")
+        dst_file = Path(dst_dir, f"{name}.csv.gz" if compression == "gzip" else f"{name}.csv")
+        if not src_file.exists():
+            current_run.log_warning(f"No {name} data to export, the table has not been extracted")
+            continue
+        if dst_file.exists() and dst_file.stat().st_mtime >= src_file.stat().st_mtime:
+            current_run.log_info(f"CSV copy of {name} data is up to date, skipping")
+            continue
 
+        write_csv(src_file, dst_file, compression=compression)
+        current_run.log_info(f"Exported {name} data to {dst_file.name}")
         if get_environment() == Environment.CLOUD_PIPELINE:
-            current_run.add_file_output(dst_file_pqt.as_posix())
-            current_run.add_file_output(dst_file_csv.as_posix())
+            current_run.add_file_output(dst_file.as_posix())
+
+    return True
+
+
+@moodle_extract.task
+def profile_queries(db: str, dst_dir: Path, tables: list[str] | None = None):
+    """Profile the extraction queries and save the results as a JSON artifact."""
+    engine = create_session_engine(db)
+    profiles = []
+
+    try:
+        with engine.connect() as con:
+            for name in tables or list(QUERIES):
+                current_run.log_info(f"Profiling {name} query")
+                profile = profile_query(con, name, QUERIES[name])
+                current_run.log_info(
+                    f"Query {name} took {profile['duration']}s "
+                    f"({profile['rows_examined']} rows examined)"
+                )
+                for table in profile["full_scans"]:
+                    current_run.log_warning(f"Full scan of table `{table}` in {name} query")
+                for flag in profile["flags"]:
+                    current_run.log_info(f"{name} query: {flag}")
+                for index in profile["suggested_indexes"]:
+                    current_run.log_info(f"Suggested index for {name} query: {index}")
+                profiles.append(profile)
+    finally:
+        engine.dispose()
+
+    dst_file = Path(dst_dir, "profiles", f"{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json")
+    os.makedirs(dst_file.parent, exist_ok=True)
+    with open(dst_file, "w") as f:
+        json.dump(profiles, f, indent=2, default=str)
+
+    if get_environment() == Environment.CLOUD_PIPELINE:
+        current_run.add_file_output(dst_file.as_posix())
 
     return True
 
@@ -0,0 +1,111 @@
+"""Profiling of the Moodle extraction queries."""
+
+import re
+from time import perf_counter
+
+from sqlalchemy import Connection, text
+from sqlalchemy.exc import ProgrammingError
+
+# plan details worth flagging in addition to full table scans
+EXTRA_FLAGS = ["Using temporary", "Using filesort", "Using join buffer"]
+
+# MySQL error code of syntax errors
+ER_PARSE_ERROR = 1064
+
+
+def explain(con: Connection, query: str) -> list[dict]:
+    """Get the execution plan of a query (one row per table)."""
+    r = con.execute(text(f"EXPLAIN {query}"))
+    return [dict(row._mapping) for row in r]
+
+
+def explain_analyze(con: Connection, query: str) -> str | None:
+    """Execute a query and get its plan with actual timings.
+
+    Uses `EXPLAIN ANALYZE` (MySQL >= 8.0.18) or `ANALYZE FORMAT=JSON` (MariaDB). Returns
+    None if none of them is supported by the server.
+    """
+    for statement in ("EXPLAIN ANALYZE", "ANALYZE FORMAT=JSON"):
+        try:
+            r = con.execute(text(f"{statement} {query}"))
+            return "\n".join(str(row[0]) for row in r)
+        except ProgrammingError as e:
+            # statements unknown to the server are syntax errors
+            if e.orig.args[0] != ER_PARSE_ERROR:
+                raise
+            con.rollback()
+    return None
+
+
+def handler_reads(con: Connection) -> int:
+    """Get the number of rows read by the storage engine in the current session."""
+    r = con.execute(text("SHOW SESSION STATUS LIKE 'Handler_read%'"))
+    return sum(int(row[1]) for row in r)
+
+
+def parse_aliases(query: str) -> dict:
+    """Map table aliases to table names in a query."""
+    matches = re.findall(r"(?:FROM|JOIN)\s+(\w+)\s+AS\s+(\w+)", query, flags=re.IGNORECASE)
+    return {alias: table for table, alias in matches}
+
+
+def parse_filter_columns(query: str) -> list[tuple[str, str]]:
+    """Get (alias, column) pairs used in join conditions and filters of a query."""
+    columns = []
+    for left_alias, left_col, right_alias, right_col in re.findall(
+        r"\bON\s+(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", query, flags=re.IGNORECASE
+    ):
+        columns += [(left_alias, left_col), (right_alias, right_col)]
+    where = re.split(r"\bWHERE\b", query, maxsplit=1, flags=re.IGNORECASE)
+    if len(where) > 1:
+        columns += re.findall(r"(\w+)\.(\w+)\s*(?:=|<|>|IN\b|IS\b)", where[1], flags=re.IGNORECASE)
+    return list(dict.fromkeys(columns))
+
+
+def suggest_indexes(query: str, full_scans: list[str]) -> list[str]:
+    """Suggest indexes for tables fully scanned in a query.
+
+    An index is suggested for each column of a fully scanned table used in a join
+    condition or a filter, except primary keys.
+    """
+    aliases = parse_aliases(query)
+    suggestions = []
+    for alias, column in parse_filter_columns(query):
+        if alias not in full_scans or alias not in aliases or column == "id":
+            continue
+        table = aliases[alias]
+        suggestions.append(f"CREATE INDEX idx_{table}_{column} ON {table} ({column});")
+    return suggestions
+
+
+def profile_query(con: Connection, name: str, query: str) -> dict:
+    """Profile a query: execution plan, duration, rows examined and index suggestions."""
+    plan = explain(con, query)
+
+    reads = handler_reads(con)
+    start = perf_counter()
+    analyze = explain_analyze(con, query)
+    if analyze is None:
+        con.execute(text(query)).fetchall()
+    duration = perf_counter() - start
+    rows_examined = handler_reads(con) - reads
+
+    full_scans = [row["table"] for row in plan if row.get("type") == "ALL"]
+    flags = [
+        f"{row['table']}: {flag}"
+        for row in plan
+        for flag in EXTRA_FLAGS
+        if flag in (row.get("Extra") or "")
+    ]
+
+    return {
+        "name": name,
+        "query": query,
+        "duration": round(duration, 3),
+        "rows_examined": rows_examined,
+        "full_scans": full_scans,
+        "flags": flags,
+        "suggested_indexes": suggest_indexes(query, full_scans),
+        "plan": plan,
+        "analyze": analyze,
+    }
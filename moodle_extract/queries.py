@@ -1,3 +1,7 @@
+import polars as pl
+from sqlalchemy import TextClause, bindparam, text
+from sqlalchemy.dialects import mysql
+
 QUERIES = {}
 
 QUERIES["users"] = """
@@ -5,8 +9,8 @@ SELECT
   user_.id AS user_id,
   user_.firstname AS first_name,
   user_.lastname AS last_name,
-  from_unixtime (user_.timecreated) AS time_created,
-  from_unixtime (user_.lastaccess) AS last_access,
+  user_.timecreated AS time_created,
+  user_.lastaccess AS last_access,
   cohort.idnumber AS org_unit,
   (CASE
     WHEN customdata.gender = '1' THEN 'Male'
@@ -48,13 +52,14 @@ WHERE
 
 QUERIES["grades"] = """
 SELECT
+  grade.id AS grade_id,
   grade.userid AS user_id,
   gradeitem.courseid AS course_id,
   grade.rawgrade AS grade,
   grade.rawgrademax AS grade_max,
   ROUND((grade.rawgrade / grade.rawgrademax * 100), 2) AS score,
   gradeitem.itemname AS item_name,
-  from_unixtime(grade.timemodified) as time_modified
+  grade.timemodified AS time_modified
 FROM
   mdl_grade_grades AS grade
   LEFT JOIN mdl_grade_items AS gradeitem ON grade.itemid = gradeitem.id
@@ -84,9 +89,10 @@ FROM
 
 QUERIES["enrollments"] = """
 SELECT
+  userenrol.id AS enrollment_id,
   userenrol.userid AS user_id,
   enrol.courseid AS course_id,
-  from_unixtime (userenrol.timecreated) AS enrollment_date
+  userenrol.timecreated AS enrollment_date
 FROM
   mdl_user_enrolments AS userenrol
   LEFT JOIN mdl_enrol AS enrol ON userenrol.enrolid = enrol.id
@@ -95,9 +101,10 @@ FROM
 
 QUERIES["certificates"] = """
 SELECT
+  issues.id AS certificate_id,
   issues.userid AS user_id,
   template_.name AS certificate_name,
-  from_unixtime (issues.timecreated) AS issue_date,
+  issues.timecreated AS issue_date,
   issues.courseid AS course_id
 FROM
   mdl_tool_certificate_issues AS issues
@@ -107,12 +114,13 @@ FROM
 
 QUERIES["completions"] = """
 SELECT
+  completion.id AS completion_id,
   completion.userid AS user_id,
   coursemodule.course AS course_id,
   completion.coursemoduleid AS course_module_id,
   quiz.name AS quiz_name,
   completion.completionstate AS completion_state,
-  from_unixtime (completion.timemodified) AS time_modified
+  completion.timemodified AS time_modified
 FROM
   mdl_course_modules_completion AS completion
   LEFT JOIN mdl_course_modules AS coursemodule ON completion.coursemoduleid = coursemodule.id
@@ -120,3 +128,148 @@ FROM
 WHERE
   coursemodule.module = 18
 """
+
+
+# definition of the tables extracted from each query
+# - `key`: output columns identifying a row, used to merge partial extractions into the
+#   existing dataset
+# - `user`: user ID column in the query, used to filter rows by cohort
+# - `watermark`: last-modification column (unix timestamp) of the main table of the
+#   query, used for incremental extraction and time windows. rows deleted in Moodle are
+#   not detected in incremental mode.
+# - `batch_key`: primary key column of the main table of the query, used to extract
+#   large tables in batches with keyset pagination (its output name is `key`)
+# - `partition`: date column used to partition the table by year
+# - `timestamps`: output columns fetched as unix timestamps and converted to UTC
+#   datetimes (without time zone) after extraction. they used to be converted with
+#   from_unixtime, in the time zone of the database session
+# - `dtypes`: types of output columns that cannot be inferred from query results
+#   (DECIMAL columns, read as python decimals, or columns that may be null in a whole
+#   batch). tables extracted in batches declare all their columns other than
+#   timestamps, so that all batches have the same schema
+TABLES = {
+    "users": {
+        "key": ["user_id"],
+        "user": "user_.id",
+        "timestamps": ["time_created", "last_access"],
+    },
+    "courses": {
+        "key": ["course_id"],
+    },
+    "grades": {
+        "key": ["grade_id"],
+        "user": "grade.userid",
+        "watermark": "grade.timemodified",
+        "batch_key": "grade.id",
+        "partition": "time_modified",
+        "timestamps": ["time_modified"],
+        "dtypes": {
+            "grade_id": pl.Int64,
+            "user_id": pl.Int64,
+            "course_id": pl.Int64,
+            "grade": pl.Float64,
+            "grade_max": pl.Float64,
+            "score": pl.Float64,
+            "item_name": pl.Utf8,
+        },
+    },
+    "enrollments": {
+        "key": ["enrollment_id"],
+        "user": "userenrol.userid",
+        "watermark": "userenrol.timemodified",
+        "partition": "enrollment_date",
+        "timestamps": ["enrollment_date"],
+    },
+    "certificates": {
+        "key": ["certificate_id"],
+        "user": "issues.userid",
+        "watermark": "issues.timecreated",
+        "partition": "issue_date",
+        "timestamps": ["issue_date"],
+    },
+    "completions": {
+        "key": ["completion_id"],
+        "user": "completion.userid",
+        "watermark": "completion.timemodified",
+        "batch_key": "completion.id",
+        "partition": "time_modified",
+        "timestamps": ["time_modified"],
+        "dtypes": {
+            "completion_id": pl.Int64,
+            "user_id": pl.Int64,
+            "course_id": pl.Int64,
+            "course_module_id": pl.Int64,
+            "quiz_name": pl.Utf8,
+            "completion_state": pl.Int64,
+        },
+    },
+}
+
+
+def build_query(
+    name: str,
+    since: int | None = None,
+    until: int | None = None,
+    org_units: list[str] | None = None,
+    columns: list[str] | None = None,
+    after: int | None = None,
+    limit: int | None = None,
+) -> TextClause:
+    """Build the query of a table with filters pushed down to the database.
+
+    `since` and `until` are unix timestamps (`until` excluded). `after` and `limit`
+    paginate on the batch key of the table.
+    """
+    table = TABLES[name]
+    conditions = []
+    params = {}
+    bind = []
+
+    if since is not None or until is not None:
+        if "watermark" not in table:
+            raise ValueError(f"Table {name} cannot be filtered by modification time")
+        if since is not None:
+            conditions.append(f"{table['watermark']} >= :since")
+            params["since"] = since
+        if until is not None:
+            conditions.append(f"{table['watermark']} < :until")
+            params["until"] = until
+
+    if org_units:
+        if "user" not in table:
+            raise ValueError(f"Table {name} cannot be filtered by org unit")
+        conditions.append(
+            f"{table['user']} IN (SELECT members.userid FROM mdl_cohort_members AS members "
+            "JOIN mdl_cohort AS cohort ON members.cohortid = cohort.id "
+            "WHERE cohort.idnumber IN :org_units)"
+        )
+        bind.append(bindparam("org_units", value=list(org_units), expanding=True))
+
+    if after is not None or limit is not None:
+        if "batch_key" not in table:
+            raise ValueError(f"Table {name} cannot be extracted in batches")
+        if after is not None:
+            conditions.append(f"{table['batch_key']} > :after")
+            params["after"] = after
+
+    sql = QUERIES[name].rstrip()
+    for condition in conditions:
+        if "WHERE" in sql.upper():
+            sql += f"\n  AND {condition}"
+        else:
+            sql += f"\nWHERE\n  {condition}"
+
+    if limit is not None:
+        sql += f"\nORDER BY {table['batch_key']}\nLIMIT :limit"
+        params["limit"] = limit
+
+    if columns:
+        sql = f"SELECT {', '.join(f'q.{c}' for c in columns)} FROM ({sql}\n) AS q"
+
+    return text(sql + "\n").bindparams(*bind, **params)
+
+
+def render_query(query: TextClause) -> str:
+    """Render a parameterized query as plain SQL, for readers without parameter binding."""
+    dialect = mysql.dialect(paramstyle="named")
+    return str(query.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
@@ -0,0 +1,82 @@
+"""Persistent local copy of DHIS2 tracker data."""
+
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+import polars as pl
+from openhexa.sdk import current_run
+
+# time (seconds) subtracted from the last refresh time when requesting updated objects,
+# so that objects being updated while the cache was refreshed are not missed
+REFRESH_LOOKBACK = 600
+
+UPDATED_AFTER_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def update_state(state: pl.DataFrame, objects: pl.DataFrame, on: str) -> pl.DataFrame:
+    """Add or replace objects in a local copy of DHIS2 data.
+
+    Columns missing from the new objects are taken from the replaced rows, if any.
+    """
+    if objects.is_empty():
+        return state
+    if state.is_empty() or on not in state.columns:
+        return objects
+
+    missing = [c for c in state.columns if c not in objects.columns]
+    if missing:
+        objects = objects.join(other=state.select([on] + missing), on=on, how="left")
+    state = state.join(other=objects.select(on), on=on, how="anti")
+    return pl.concat([state, objects], how="diagonal_relaxed")
+
+
+def read_refresh_time(fp: Path) -> datetime | None:
+    """Read the DHIS2 server time of the last refresh of a cached dataset."""
+    if not fp.exists():
+        return None
+    with open(fp) as f:
+        return datetime.fromisoformat(json.load(f)["refreshed_at"])
+
+
+def write_refresh_time(fp: Path, refreshed_at: datetime):
+    """Store the DHIS2 server time of the last refresh of a cached dataset."""
+    with open(fp, "w") as f:
+        json.dump({"refreshed_at": refreshed_at.isoformat()}, f)
+
+
+def get_cached(
+    cache_dir: Path,
+    name: str,
+    on: str,
+    fetch: Callable[[str | None], pl.DataFrame],
+    server_time: datetime,
+    full_refresh: bool = False,
+) -> pl.DataFrame:
+    """Get DHIS2 data from the local cache, refreshed with objects updated since the last run."""
+    fp = Path(cache_dir, f"{name}.parquet")
+    fp_refresh = Path(cache_dir, f"{name}.refresh.json")
+    refreshed_at = read_refresh_time(fp_refresh)
+
+    if full_refresh or refreshed_at is None or not fp.exists():
+        current_run.log_info(f"Fetching all {name} from DHIS2")
+        df = fetch(None)
+    else:
+        since = refreshed_at - timedelta(seconds=REFRESH_LOOKBACK)
+        current_run.log_info(f"Fetching {name} updated in DHIS2 since {since}")
+        updated = fetch(since.strftime(UPDATED_AFTER_FORMAT))
+        current_run.log_info(f"{len(updated)} {name} updated since last refresh")
+        df = update_state(pl.read_parquet(fp), updated, on)
+
+    if "deleted" in df.columns:
+        df = df.filter(~pl.col("deleted").fill_null(False))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = Path(cache_dir, f"{name}.parquet.tmp")
+    df.write_parquet(tmp_file)
+    os.replace(tmp_file, fp)
+    write_refresh_time(fp_refresh, server_time)
+
+    return df
@@ -0,0 +1,53 @@
+"""Columnar change detection between Moodle data and DHIS2 Tracker data."""
+
+from typing import List
+
+import polars as pl
+
+
+def diff(
+    src: pl.DataFrame,
+    dst: pl.DataFrame,
+    on: str,
+    columns: dict,
+    keep: List[str] = None,
+    ignore_null: bool = False,
+) -> pl.DataFrame:
+    """Compare source data with existing DHIS2 objects, column-wise and as strings.
+
+    `columns` maps destination columns to the source expressions they are compared
+    with. Destination values are added with a `dst_` prefix, and `changed_columns`
+    lists the destination columns whose value differ.
+    """
+    dst_columns = list(columns) + [c for c in keep or [] if c not in columns]
+
+    if dst.is_empty() or on not in dst.columns:
+        dst = pl.DataFrame(schema={on: pl.Utf8})
+    dst = dst.unique(subset=on, keep="first", maintain_order=True).select(
+        [pl.col(on).cast(pl.Utf8)]
+        + [
+            (pl.col(c) if c in dst.columns else pl.lit(None)).alias(f"dst_{c}")
+            for c in dst_columns
+        ]
+    )
+
+    df = src.with_columns(pl.col(on).cast(pl.Utf8)).join(other=dst, on=on, how="left")
+
+    changes = []
+    for column, expr in columns.items():
+        src_value = expr.cast(pl.Utf8)
+        dst_value = pl.col(f"dst_{column}").cast(pl.Utf8)
+        changed = src_value.ne_missing(dst_value)
+        if ignore_null:
+            changed = changed & src_value.is_not_null()
+        changes.append(pl.when(changed).then(pl.lit(column)))
+
+    if not changes:
+        return df.with_columns(pl.lit([], dtype=pl.List(pl.Utf8)).alias("changed_columns"))
+
+    return df.with_columns(pl.concat_list(changes).list.drop_nulls().alias("changed_columns"))
+
+
+def changed(df: pl.DataFrame) -> pl.DataFrame:
+    """Only keep rows with at least one changed column."""
+    return df.filter(pl.col("changed_columns").list.len() > 0)
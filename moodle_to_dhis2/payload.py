@@ -0,0 +1,42 @@
+"""Serialization of tracker import payloads."""
+
+import gzip
+import json
+from pathlib import Path
+from typing import List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode(obj: dict) -> bytes:
+    """Encode an object as JSON, with orjson if available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def write_payload(objects: List[dict], fp: Path, compress: bool = False) -> List[bytes]:
+    """Encode payload objects and write them to a JSON file, optionally gzip-compressed.
+
+    Objects are encoded only once: the encoded objects are returned so that they can
+    be used to build request bodies.
+    """
+    encoded = [encode(obj) for obj in objects]
+
+    with (gzip.open if compress else open)(fp, "wb") as f:
+        f.write(b"[")
+        for i, obj in enumerate(encoded):
+            if i > 0:
+                f.write(b",")
+            f.write(obj)
+        f.write(b"]")
+
+    return encoded
+
+
+def request_body(payload_type: str, objects: List[bytes]) -> bytes:
+    """Build a tracker import request body from encoded objects."""
+    return b'{"' + payload_type.encode() + b'":[' + b",".join(objects) + b"]}"
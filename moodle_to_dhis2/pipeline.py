@@ -1,23 +1,32 @@
 """Template for newly generated pipelines."""
 
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from time import sleep
-from typing import List
+from time import monotonic, sleep
+from typing import Callable, List
 
 import polars as pl
+from cache import get_cached, update_state
+from diff import changed, diff
 from openhexa.sdk import current_run, parameter, pipeline, workspace
 from openhexa.toolbox.dhis2 import DHIS2
+from payload import encode, request_body, write_payload
+from stages import run_stages
 from tracker import (
     IS_SISTER_OPTION_SET,
+    JOB_TIMEOUT,
     TRACKED_ENTITY_TYPE,
-    generate_uid,
+    UidPool,
+    format_tracked_entities,
     get_enrollments,
     get_events,
+    get_imported_uids,
     get_program_org_units,
+    get_server_time,
     get_tracked_entities,
+    wait_for_job,
 )
 
 STORED_BY = "Bluesquare"
@@ -84,6 +93,15 @@ LEARNING_PROGRAM_STAGE_UID = "iW8k954zTRK"
 ENROLLMENTS_PROGRAM_UID = "kOWbqri5tY2"
 ENROLLMENTS_PROGRAM_STAGE_UID = "mHBassGTx51"
 
+COURSE_OPTION_SET_UID = "uNtNb2JcvWM"
+MODULE_OPTION_SET_UID = "rzmshuuPjEV"
+
+# maximum number of times a failed tracker import job or request is submitted again
+MAX_RETRIES = 3
+
+# delay (seconds) before retrying a failed request, multiplied by the attempt number
+RETRY_DELAY = 5
+
 
 @pipeline("moodle-to-dhis2")
 @parameter(
@@ -107,12 +125,52 @@ ENROLLMENTS_PROGRAM_STAGE_UID = "mHBassGTx51"
     choices=["FULL", "FAIL_FAST", "SKIP"],
     default="FAIL_FAST",
 )
+@parameter(
+    "chunk_size",
+    name="Import chunk size",
+    help="Maximum number of objects per tracker import job (0 to import all objects at once)",
+    type=int,
+    default=5000,
+)
+@parameter(
+    "max_jobs",
+    name="Max concurrent imports",
+    help="Maximum number of tracker import jobs running at the same time",
+    type=int,
+    default=2,
+)
+@parameter(
+    "full_refresh",
+    name="Full refresh",
+    help="Fetch all tracker data from DHIS2 instead of only data updated since the previous run",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "local_uids",
+    name="Generate UIDs locally",
+    help="Generate UIDs of new objects locally instead of requesting them from DHIS2",
+    type=bool,
+    default=False,
+)
+@parameter(
+    "compress_payloads",
+    name="Compress payloads",
+    help="Write import payloads to the output directory as gzip-compressed JSON files",
+    type=bool,
+    default=False,
+)
 @parameter("input_dir", name="Input directory", type=str, default="moodle/data/raw")
 @parameter("output_dir", name="Output directory", type=str, default="moodle/dhis2")
 def moodle_to_dhis2(
     import_mode: str,
     import_strategy: str,
     validation_mode: str,
+    chunk_size: int,
+    max_jobs: int,
+    full_refresh: bool,
+    local_uids: bool,
+    compress_payloads: bool,
     input_dir: str,
     output_dir: str,
 ):
@@ -121,6 +179,7 @@ def moodle_to_dhis2(
     Pipeline functions should only call tasks and should never perform IO operations or expensive computations.
     """
     input_dir = Path(workspace.files_path, input_dir)
+    cache_dir = Path(workspace.files_path, output_dir, "cache")
     output_dir = Path(
         workspace.files_path, output_dir, datetime.now().strftime("%Y-%m-%d_%H:%M:%s")
     )
@@ -131,8 +190,14 @@ def moodle_to_dhis2(
         import_mode=import_mode,
         import_strategy=import_strategy,
         validation_mode=validation_mode,
+        chunk_size=chunk_size,
+        max_jobs=max_jobs,
+        full_refresh=full_refresh,
+        local_uids=local_uids,
+        compress_payloads=compress_payloads,
         input_dir=input_dir,
         output_dir=output_dir,
+        cache_dir=cache_dir,
     )
 
 
@@ -191,38 +256,53 @@ def transform_users(
     )
 
     # ignore tracked entities with duplicated user IDs (forbidden by program)
-    duplicates = users.filter(pl.col("user_id").is_duplicated())
-    if not duplicates.is_empty():
-        for user_id in duplicates["user_id"].unique():
-            current_run.log_info(
-                f"Ignoring user {user_id} because they are linked to multiple entities"
-            )
-            users = users.filter(pl.col("user_id") != user_id)
+    duplicated = pl.col("user_id").is_duplicated()
+    for user_id in users.filter(duplicated)["user_id"].unique(maintain_order=True):
+        current_run.log_info(
+            f"Ignoring user {user_id} because they are linked to multiple entities"
+        )
+    users = users.filter(~duplicated)
 
     # ignore tracked entities whose org unit has changed (not supported by current data
     # model in dhis2)
+    # the org unit of a tracked entity transfered to another facility is the one of its
+    # last program owner
     transfered = 0
-    for user in users.iter_rows(named=True):
-        if user["trackedEntity"] in tracked_entities["trackedEntity"]:
-            tracked_entity = tracked_entities.row(
-                by_predicate=pl.col("trackedEntity") == user["trackedEntity"],
-                named=True,
+    if "trackedEntity" in tracked_entities.columns:
+        owners = tracked_entities.select(
+            [
+                pl.col("trackedEntity"),
+                pl.col("orgUnit").alias("dst_org_unit"),
+                pl.lit(False).alias("transfered"),
+            ]
+        )
+        dtype = tracked_entities.schema.get("programOwners")
+        if isinstance(dtype, pl.List) and isinstance(dtype.inner, pl.Struct):
+            has_owners = (pl.col("programOwners").list.len() > 0).fill_null(False)
+            owners = tracked_entities.select(
+                [
+                    pl.col("trackedEntity"),
+                    pl.when(has_owners)
+                    .then(pl.col("programOwners").list.last().struct.field("orgUnit"))
+                    .otherwise(pl.col("orgUnit"))
+                    .alias("dst_org_unit"),
+                    has_owners.alias("transfered"),
+                ]
             )
-            
-            src_ou = user["org_unit"]
-            dst_ou = tracked_entity["orgUnit"]
-            #allow events for users whose org unit has changed but keep existing org unit to avoid update failure and ignore org unit changes for existing tracked entities. 
-            # Skipping org unit comparison for existing tracked entities because org unit changes are not supported by current data model in DHIS2 and can be caused by users transfer between facilities which is a common scenario in LifeNet context.
-            if "programOwners" in tracked_entity and tracked_entity["programOwners"]:
-                current_owner = tracked_entity["programOwners"][-1]
-                dst_ou = current_owner["orgUnit"]
-                transfered += 1
-            if src_ou != dst_ou:
-                current_run.log_info(
-                    f"Ignoring user {user['user_id']} because its org unit has changed from {dst_ou} to {src_ou} (not supported)" 
-                )
-                users = users.filter(pl.col("user_id") != user["user_id"])
-    
+        owners = owners.unique(subset="trackedEntity", keep="first", maintain_order=True)
+
+        matched = users.join(other=owners, on="trackedEntity", how="left").filter(
+            pl.col("transfered").is_not_null()
+        )
+        transfered = matched["transfered"].sum()
+
+        rejected = matched.filter(pl.col("org_unit").ne_missing(pl.col("dst_org_unit")))
+        for user in rejected.iter_rows(named=True):
+            current_run.log_info(
+                f"Ignoring user {user['user_id']} because its org unit has changed from {user['dst_org_unit']} to {user['org_unit']} (not supported)"
+            )
+        users = users.join(other=rejected.select("user_id"), on="user_id", how="anti")
+
     current_run.log_info(f"Transfered {transfered} users with program ownership updates considered")
     # convert datetimes to string as expected by DHIS2
     users = users.with_columns(
@@ -236,148 +316,125 @@ def transform_users(
 
 
 def build_tracked_entities_payload(
-    dhis2: DHIS2, users: pl.DataFrame, tracked_entities: pl.DataFrame
+    dhis2: DHIS2,
+    users: pl.DataFrame,
+    tracked_entities: pl.DataFrame,
+    uids: UidPool = None,
 ) -> List[dict]:
-    """Build JSON payload for tracked entities import."""
-    uids = generate_uid(dhis2, n=len(users))
-    payload = []
+    """Build JSON payload for tracked entities import.
 
-    for user in users.iter_rows(named=True):
-        attributes = []
+    Users are compared column-wise with the tracked entities already existing in DHIS2,
+    so that only new or modified entities are added to the payload.
+    """
+    uids = uids or UidPool(dhis2)
+    if "trackedEntity" in tracked_entities.columns:
+        uids.exclude(tracked_entities["trackedEntity"])
 
-        # transform entity attributes into a list of dict
-        for column, value in user.items():
-            if column in TRACKED_ENTITY_ATTRIBUTES and value is not None:
-                attributes.append(
-                    {"attribute": TRACKED_ENTITY_ATTRIBUTES[column], "value": value}
-                )
+    users = diff(
+        src=users,
+        dst=tracked_entities,
+        on="trackedEntity",
+        columns={
+            "trackedEntityType": pl.lit(TRACKED_ENTITY_TYPE),
+            "orgUnit": pl.col("org_unit"),
+            **{
+                column: pl.col(column) if column in users.columns else pl.lit(None)
+                for column in TRACKED_ENTITY_ATTRIBUTES
+            },
+        },
+    )
+    users = users.with_columns(
+        (
+            pl.col("trackedEntity").is_not_null()
+            & pl.col("changed_columns").list.contains("orgUnit")
+        ).alias("org_unit_changed")
+    )
 
-        # check if the user alreay belongs to a tracked entity in DHIS2
-        # if they do, get current data associated with the tracked entity for comparison
-        # with the new data extracted from Moodle
-        if user.get("trackedEntity"):
-            uid = user["trackedEntity"]
-            dst_entity = tracked_entities.row(
-                by_predicate=pl.col("trackedEntity") == uid, named=True
-            )
+    for user in users.filter(pl.col("org_unit_changed")).iter_rows(named=True):
+        current_run.log_info(
+            f"Org unit change detected for user {user['user_id']}: "
+            f"{user['dst_orgUnit']} -> {user['org_unit']}"
+        )
+
+    # keep existing org unit to avoid update failure
+    users = users.with_columns(
+        pl.when(pl.col("org_unit_changed"))
+        .then(pl.col("dst_orgUnit"))
+        .otherwise(pl.col("org_unit"))
+        .alias("org_unit")
+    )
 
-            # rebuild the payload from the data extracted from DHIS2
-            dst_entity["attributes"] = []
-            for column in dst_entity:
-                if column in TRACKED_ENTITY_ATTRIBUTES:
-                    dst_entity["attributes"].append(
-                        {
-                            "attribute": TRACKED_ENTITY_ATTRIBUTES[column],
-                            "value": dst_entity[column],
-                        }
-                    )
+    # add entities to payload only if changes are detected
+    payload = []
+    attribute_columns = [c for c in users.columns if c in TRACKED_ENTITY_ATTRIBUTES]
+    for user in changed(users).iter_rows(named=True):
+        # transform entity attributes into a list of dict
+        attributes = [
+            {"attribute": TRACKED_ENTITY_ATTRIBUTES[column], "value": user[column]}
+            for column in attribute_columns
+            if user[column] is not None
+        ]
 
         # the user do not belong to an existing tracked entity in DHIS2
         # therefore we use a new UID
-        else:
-            uid = uids.pop()
-            dst_entity = None
-
-        src_entity = {
-            "trackedEntity": uid,
-            "trackedEntityType": TRACKED_ENTITY_TYPE,
-            "orgUnit": user["org_unit"],
-            "attributes": attributes,
-        }
-
-        def _get_attribute_value(
-            attributes: List[dict], dx_uid: str
-        ) -> str | int | None:
-            """Get attribute value from list of dict format in payload."""
-            for attr in attributes:
-                if attr["attribute"] == dx_uid:
-                    return attr["value"]
-            return None
-
-        # check for changes before adding to payload
-        changed = False
-        if not dst_entity:
-            changed = True
-        else:
-            for key in ["trackedEntity", "trackedEntityType", "orgUnit"]:
-                if str(src_entity[key]) != str(dst_entity[key]):
-                    if key == "orgUnit":
-                        current_run.log_info(
-                            f"Org unit change detected for user {user['user_id']}: "
-                            f"{dst_entity[key]} -> {src_entity[key]}"
-                        )
-                    src_entity[key] = dst_entity[key]  # keep existing org unit to avoid update failure
-                    changed = True
-                    break
-            if not changed:
-                for name, dx in TRACKED_ENTITY_ATTRIBUTES.items():
-                    src = _get_attribute_value(src_entity["attributes"], dx)
-                    dst = _get_attribute_value(dst_entity["attributes"], dx)
-                    if src is None and dst is None:
-                        continue
-                    if str(src) != str(dst):
-                        changed = True
-                        break
-
-        # add entity to payload only if changes are detected
-        if changed:
-            payload.append(src_entity)
+        uid = user["trackedEntity"] or uids.pop()
+
+        payload.append(
+            {
+                "trackedEntity": uid,
+                "trackedEntityType": TRACKED_ENTITY_TYPE,
+                "orgUnit": user["org_unit"],
+                "attributes": attributes,
+            }
+        )
 
     return payload
 
 
 def build_enrollments_payload(
-    dhis2: DHIS2, users: pl.DataFrame, enrollments: pl.DataFrame, program_uid: str
+    dhis2: DHIS2,
+    users: pl.DataFrame,
+    enrollments: pl.DataFrame,
+    program_uid: str,
+    uids: UidPool = None,
 ) -> List[dict]:
     """Build JSON payload for program enrollments."""
-    uids = generate_uid(dhis2, n=len(users))
+    uids = uids or UidPool(dhis2)
+    if "enrollment" in enrollments.columns:
+        uids.exclude(enrollments["enrollment"])
     payload = []
 
-    for user in users.iter_rows(named=True):
-        if not user.get("trackedEntity") or not user.get("org_unit"):
-            continue
-
-        if "trackedEntity" in enrollments.columns and "orgUnit" in enrollments.columns:
-            try:
-                dst_enrol = enrollments.row(
-                    by_predicate=(pl.col("trackedEntity") == user["trackedEntity"]),
-                    named=True,
-                )
-                uid = dst_enrol["enrollment"]
-            except pl.exceptions.NoRowsReturnedError:
-                dst_enrol = {}
-                uid = uids.pop()
-        else:
-            dst_enrol = {}
-            uid = uids.pop()
-
-        src_enrol = {
-            "enrolledAt": user["time_created"],
-            "enrollment": uid,
-            "occurredAt": user["time_created"],
-            "orgUnit": user["org_unit"],
-            "program": program_uid,
-            "status": "ACTIVE",
-            "trackedEntity": user["trackedEntity"],
-            "trackedEntityType": TRACKED_ENTITY_TYPE,
-        }
-
-        dst_enrol = {k: v for k, v in dst_enrol.items() if k in src_enrol}
+    users = users.filter(
+        pl.col("trackedEntity").is_not_null() & pl.col("org_unit").is_not_null()
+    )
 
-        same = True
-        for key in [
-            "enrollment",
-            "trackedEntity",
-            "program",
-            "status",
-            "orgUnit",
-            "enrolledAt",
-        ]:
-            if src_enrol.get(key) != dst_enrol.get(key):
-                same = False
+    # compare with existing enrollment of the tracked entity, if any
+    users = diff(
+        src=users,
+        dst=enrollments,
+        on="trackedEntity",
+        columns={
+            "program": pl.lit(program_uid),
+            "status": pl.lit("ACTIVE"),
+            "orgUnit": pl.col("org_unit"),
+            "enrolledAt": pl.col("time_created"),
+        },
+        keep=["enrollment"],
+    )
 
-        if not same:
-            payload.append(src_enrol)
+    for user in changed(users).iter_rows(named=True):
+        payload.append(
+            {
+                "enrolledAt": user["time_created"],
+                "enrollment": user["dst_enrollment"] or uids.pop(),
+                "occurredAt": user["time_created"],
+                "orgUnit": user["org_unit"],
+                "program": program_uid,
+                "status": "ACTIVE",
+                "trackedEntity": user["trackedEntity"],
+                "trackedEntityType": TRACKED_ENTITY_TYPE,
+            }
+        )
 
     return payload
 
@@ -483,11 +540,12 @@ def transform_grades(
 
 
 def build_grade_events_payload(
-    dhis2: DHIS2, grades: pl.DataFrame, events: pl.DataFrame
+    dhis2: DHIS2, grades: pl.DataFrame, events: pl.DataFrame, uids: UidPool = None
 ) -> List[dict]:
     """Build JSON payload for events (LifeNet Digital Learning program)."""
     payload = []
-    uids = generate_uid(dhis2, n=len(grades))
+    uids = uids or UidPool(dhis2)
+    uids.exclude(events["event"])
 
     # make sure data types are correct in events data
     events = events.with_columns(
@@ -497,61 +555,45 @@ def build_grade_events_payload(
             pl.col("course_id").cast(int),
         ]
     )
-    existing_events = 0
-    new_events = 0
-    events_from_old_ougnits = 0
-    for grade in grades.iter_rows(named=True):
-        if grade.get("event"):
-            uid = grade["event"]
-            dst = events.row(by_predicate=pl.col("event") == uid, named=True)
-            existing_events += 1
-        else:
-            uid = uids.pop()
-            dst = {}
-            new_events += 1
+    current_run.log_info(f"Found {grades['event'].is_not_null().sum()} existing grade events.")
+    current_run.log_info(f"Found {grades['event'].is_null().sum()} new grade events.")
+
+    # for each data value, compare source and destination
+    grades = diff(
+        src=grades,
+        dst=events,
+        on="event",
+        columns={c: pl.col(c) for c in LEARNING_DATA_VALUES if c in grades.columns},
+        ignore_null=True,
+    )
 
+    data_columns = [c for c in grades.columns if c in LEARNING_DATA_VALUES]
+    for grade in changed(grades).iter_rows(named=True):
         # format event data values
-        data_values = []
-        for column, value in grade.items():
-            if column in LEARNING_DATA_VALUES and value is not None:
-                data_values.append(
-                    {
-                        "storedBy": STORED_BY,
-                        "dataElement": LEARNING_DATA_VALUES[column],
-                        "value": value,
-                    }
-                )
+        data_values = [
+            {
+                "storedBy": STORED_BY,
+                "dataElement": LEARNING_DATA_VALUES[column],
+                "value": grade[column],
+            }
+            for column in data_columns
+            if grade[column] is not None
+        ]
 
-        # for each data value, compare source and destination
-        same = True
-        for col in LEARNING_DATA_VALUES:
-            if grade.get(col) is not None:
-                if str(grade.get(col)) != str(dst.get(col)):
-                    if str(grade.get(col)) == "orgUnit" and grade.get("event"):
-                        events_from_old_ougnits += 1
-                        continue # Skip existing events when org unit has changed.
-                    else:
-                        same = False
-                    break
-
-        if not same:
-            payload.append(
-                {
-                    "program": LEARNING_PROGRAM_UID,
-                    "event": uid,
-                    "programStage": LEARNING_PROGRAM_STAGE_UID,
-                    "orgUnit": grade["orgUnit"],
-                    "trackedEntity": grade["trackedEntity"],
-                    "enrollment": grade["enrollment"],
-                    "enrollmentStatus": "ACTIVE",
-                    "occurredAt": grade["time_modified"],
-                    "dataValues": data_values,
-                }
-            )
+        payload.append(
+            {
+                "program": LEARNING_PROGRAM_UID,
+                "event": grade["event"] or uids.pop(),
+                "programStage": LEARNING_PROGRAM_STAGE_UID,
+                "orgUnit": grade["orgUnit"],
+                "trackedEntity": grade["trackedEntity"],
+                "enrollment": grade["enrollment"],
+                "enrollmentStatus": "ACTIVE",
+                "occurredAt": grade["time_modified"],
+                "dataValues": data_values,
+            }
+        )
 
-    current_run.log_info(f"Found {existing_events} existing grade events.")
-    current_run.log_info(f"Found {new_events} new grade events.")
-    current_run.log_info(f"Found {events_from_old_ougnits} existing grade events with org unit changes (skipped for existing events).")
     return payload
 
 
@@ -571,16 +613,15 @@ def transform_enrollments(
     )
 
     # check if a certificate has been issued for a given user & course
-    enrollments = enrollments.with_columns(
-        pl.struct(["user_id", "course_id"])
-        .map_elements(
-            lambda x: not certificates.filter(
-                (pl.col("user_id") == x["user_id"])
-                & (pl.col("course_id") == x["course_id"])
-            ).is_empty()
-        )
-        .alias("certificate_issued")
+    certified = (
+        certificates.select(["user_id", "course_id"])
+        .unique()
+        .cast({c: enrollments.schema[c] for c in ["user_id", "course_id"]})
+        .with_columns(pl.lit(True).alias("certificate_issued"))
     )
+    enrollments = enrollments.join(
+        other=certified, on=["user_id", "course_id"], how="left"
+    ).with_columns(pl.col("certificate_issued").fill_null(False))
 
     # convert datetime to string as expected by DHIS2
     enrollments = enrollments.with_columns(
@@ -639,141 +680,239 @@ def transform_enrollments(
 
 
 def build_enrollment_events_payload(
-    dhis2: DHIS2, enrollments: pl.DataFrame, events: pl.DataFrame
+    dhis2: DHIS2, enrollments: pl.DataFrame, events: pl.DataFrame, uids: UidPool = None
 ) -> List[dict]:
     """Build JSON payload for events (LifeNet Digital Learning program)."""
     payload = []
-    uids = generate_uid(dhis2, n=len(enrollments))
+    uids = uids or UidPool(dhis2)
+    uids.exclude(events["event"])
 
     # make sure data types are correct in events data
     enrollments = enrollments.with_columns(
         [pl.col("course_id").cast(int), pl.col("user_id").cast(int)]
     )
 
-    for enrol in enrollments.iter_rows(named=True):
-        if enrol.get("event"):
-            uid = enrol["event"]
-            dst = events.row(by_predicate=pl.col("event") == uid, named=True)
-        else:
-            uid = uids.pop()
-            dst = {}
+    # for each data value, compare source and destination
+    enrollments = diff(
+        src=enrollments,
+        dst=events,
+        on="event",
+        columns={c: pl.col(c) for c in ENROLLMENTS_DATA_VALUES if c in enrollments.columns},
+        ignore_null=True,
+    )
 
+    data_columns = [c for c in enrollments.columns if c in ENROLLMENTS_DATA_VALUES]
+    for enrol in changed(enrollments).iter_rows(named=True):
         # format event data values
-        data_values = []
-        for column, value in enrol.items():
-            if column in ENROLLMENTS_DATA_VALUES and value is not None:
-                data_values.append(
-                    {
-                        "storedBy": STORED_BY,
-                        "dataElement": ENROLLMENTS_DATA_VALUES[column],
-                        "value": value,
-                    }
-                )
+        data_values = [
+            {
+                "storedBy": STORED_BY,
+                "dataElement": ENROLLMENTS_DATA_VALUES[column],
+                "value": enrol[column],
+            }
+            for column in data_columns
+            if enrol[column] is not None
+        ]
 
-        # for each data value, compare source and destination
-        same = True
-        for col in ENROLLMENTS_DATA_VALUES:
-            if enrol.get(col) is not None:
-                if str(enrol.get(col)) != str(dst.get(col)):
-                    same = False
-                    break
-
-        if not same:
-            payload.append(
-                {
-                    "program": ENROLLMENTS_PROGRAM_UID,
-                    "event": uid,
-                    "programStage": ENROLLMENTS_PROGRAM_STAGE_UID,
-                    "orgUnit": enrol["org_unit"],
-                    "trackedEntity": enrol["trackedEntity"],
-                    "occurredAt": enrol["enrollment_date"],
-                    "dataValues": data_values,
-                }
-            )
+        payload.append(
+            {
+                "program": ENROLLMENTS_PROGRAM_UID,
+                "event": enrol["event"] or uids.pop(),
+                "programStage": ENROLLMENTS_PROGRAM_STAGE_UID,
+                "orgUnit": enrol["org_unit"],
+                "trackedEntity": enrol["trackedEntity"],
+                "occurredAt": enrol["enrollment_date"],
+                "dataValues": data_values,
+            }
+        )
 
     return payload
 
 
-def add_missing_options(dhis2: DHIS2, courses: pl.DataFrame):
-    """Add missing options in option sets for courses and course modules."""
+def get_option_set(dhis2: DHIS2, uid: str) -> dict:
+    """Get an option set, with all the properties it owns, and its options.
+
+    Owned properties are all required to update the option set: the metadata import
+    replaces the whole object.
+    """
+    return dhis2.api.get(
+        f"optionSets/{uid}",
+        params={"fields": ":owner,options[id,name,code,sortOrder]"},
+    )
+
+
+def add_missing_options(dhis2: DHIS2, courses: pl.DataFrame, uids: UidPool = None):
+    """Add missing options in option sets for courses and course modules.
+
+    Missing options are created and added to their option set in a single metadata
+    import.
+    """
+    uids = uids or UidPool(dhis2)
     courses = courses.filter(pl.col("category_id").is_not_null())
 
-    # course option set
-    OPTION_SET_UID = "uNtNb2JcvWM"
+    modules = courses.select(["category_id", "category_name"]).unique()
+    modules = modules.filter(pl.col("category_id") != 54)  # "Moodle App Test Courses"
+
+    metadata = {"options": [], "optionSets": []}
+
+    for option_set_uid, rows, code_column, name_column, label in [
+        (COURSE_OPTION_SET_UID, courses, "course_id", "course_name", "course"),
+        (MODULE_OPTION_SET_UID, modules, "category_id", "category_name", "course module"),
+    ]:
+        # get existing options
+        option_set = get_option_set(dhis2, option_set_uid)
+        options = option_set.get("options", [])
+        uids.exclude(option["id"] for option in options)
+
+        # identify missing options
+        codes = [option["code"] for option in options]
+        missing = rows.filter(pl.col(code_column).cast(pl.Utf8).is_in(codes).not_())
+        if missing.is_empty():
+            continue
 
-    # get existing options
-    pages = [
-        p
-        for p in dhis2.api.get_paged(
-            "options", params={"fields": "id,name,code,optionSet"}
+        sort_order = max([option.get("sortOrder") or 0 for option in options], default=0)
+        for row in missing.iter_rows(named=True):
+            current_run.log_info(
+                f'Adding missing {label} option "{row[name_column]}" to DHIS2'
+            )
+            sort_order += 1
+            option = {
+                "id": uids.pop(),
+                "name": row[name_column],
+                "code": str(row[code_column]),
+                "sortOrder": sort_order,
+                "optionSet": {"id": option_set_uid},
+            }
+            metadata["options"].append(option)
+            options.append(option)
+
+        # the option set is updated as a whole: all its options must be listed
+        metadata["optionSets"].append(
+            {
+                **option_set,
+                "options": [{"id": option["id"]} for option in options],
+            }
         )
-    ]
-    r = dhis2.api.merge_pages(pages)
-    options = pl.DataFrame(r["options"])
-    options = options.with_columns(
-        pl.col("optionSet").struct.field("id").alias("optionSet")
-    )
-    course_options = options.filter(pl.col("optionSet") == OPTION_SET_UID)
 
-    # identify missing options
-    missing = courses.filter(
-        pl.col("course_id").is_in(course_options["code"].cast(int)).not_()
+    if not metadata["options"]:
+        return
+
+    r = dhis2.api.post(
+        "metadata",
+        json=metadata,
+        params={"importStrategy": "CREATE_AND_UPDATE", "atomicMode": "ALL"},
     )
+    report = r.json()
+    report = report.get("response", report)
+    if report.get("status") not in ["OK", "WARNING"]:
+        msg = f"Import of {len(metadata['options'])} missing options failed: {report}"
+        current_run.log_error(msg)
+        raise ValueError(msg)
 
-    # add missing course options
-    for course in missing.iter_rows(named=True):
-        current_run.log_info(
-            f'Adding missing course option "{course["course_name"]}" to DHIS2'
-        )
+    current_run.log_info(f"Added {len(metadata['options'])} missing options to DHIS2")
 
-        r = dhis2.api.get("system/id")
-        uid = r["codes"][0]
 
-        payload = {
-            "id": uid,
-            "name": course["course_name"],
-            "code": course["course_id"],
-        }
+def split_payload(payload: dict, chunk_size: int) -> List[dict]:
+    """Split a tracker import payload into chunks of at most `chunk_size` objects.
 
-        r = dhis2.api.post(
-            "options", json=payload, params={"importStrategy": "CREATE_OR_UPDATE"}
-        )
-        r = dhis2.api.post(
-            f"optionSets/{OPTION_SET_UID}/options/{uid}",
-            params={"importStrategy": "CREATE_OR_UPDATE"},
-        )
+    Chunks only contain one type of objects, in import order (tracked entities,
+    enrollments then events). Objects are encoded as JSON, if not already.
+    """
+    chunks = []
+    for payload_type in ["trackedEntities", "enrollments", "events"]:
+        objects = [
+            obj if isinstance(obj, bytes) else encode(obj)
+            for obj in payload.get(payload_type) or []
+        ]
+        size = chunk_size if chunk_size > 0 else max(len(objects), 1)
+        for i in range(0, len(objects), size):
+            chunks.append({payload_type: objects[i : i + size]})
+    return chunks
 
-    # course module option set
-    OPTION_SET_UID = "rzmshuuPjEV"
 
-    modules = courses.select(["category_id", "category_name"]).unique()
-    modules = modules.filter(pl.col("category_id") != 54)  # "Moodle App Test Courses"
-    module_options = options.filter(pl.col("optionSet") == OPTION_SET_UID)
-    missing = modules.filter(
-        pl.col("category_id").is_in(module_options["code"].cast(int)).not_()
-    )
+def is_retryable(report: dict) -> bool:
+    """Check if a failed import job can be retried.
 
-    # add missing course module options
-    for module in missing.iter_rows(named=True):
-        current_run.log_info(
-            f'Adding missing course module option "{module["category_name"]}" to DHIS2'
-        )
+    Jobs rejected because of invalid objects fail the same way when retried.
+    """
+    validation = report.get("validationReport") or {}
+    return not validation.get("errorReports")
 
-        r = dhis2.api.get("system/id")
-        uid = r["codes"][0]
 
-        payload = {
-            "id": uid,
-            "name": module["category_name"],
-            "code": module["category_id"],
-        }
+def call_with_retries(func: Callable, name: str, max_retries: int = MAX_RETRIES):
+    """Call a function, again if it raises an exception, at most `max_retries` times.
 
-        r = dhis2.api.post(
-            "options", json=payload, params={"importStrategy": "CREATE_OR_UPDATE"}
+    Timeouts are not retried.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except TimeoutError:
+            raise
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = RETRY_DELAY * (attempt + 1)
+            current_run.log_warning(f"{name} failed ({e}), retrying in {delay}s")
+            sleep(delay)
+
+
+def import_chunk(
+    dhis2: DHIS2,
+    chunk: dict,
+    params: dict,
+    name: str,
+    max_retries: int = MAX_RETRIES,
+    timeout: float = JOB_TIMEOUT,
+) -> dict:
+    """Import a payload chunk as a tracker import job and wait for its report."""
+    # objects are already encoded: the request body is built from their bytes
+    payload_type, objects = next(iter(chunk.items()))
+    body = request_body(payload_type, objects)
+
+    def submit() -> str:
+        r = dhis2.api.session.post(
+            f"{dhis2.api.url}/tracker",
+            data=body,
+            params=params,
+            headers={"Content-Type": "application/json"},
+        )
+        dhis2.api.raise_if_error(r)
+        return r.json()["response"]["id"]
+
+    for attempt in range(max_retries + 1):
+        retry = f" (attempt {attempt + 1}/{max_retries + 1})" if attempt else ""
+
+        # start import job
+        job_uid = call_with_retries(submit, f"Submission of {name}", max_retries)
+        current_run.log_info(f"Started tracker import job {job_uid} for {name}{retry}")
+
+        # requests for a started job are retried for the same job
+        deadline = monotonic() + timeout
+        call_with_retries(
+            lambda: wait_for_job(
+                dhis2,
+                job_uid,
+                timeout=max(deadline - monotonic(), 0),
+                on_progress=lambda msg: current_run.log_info(f"{name}: {msg}"),
+            ),
+            f"Status request of import job {job_uid}",
+            max_retries,
         )
-        r = dhis2.api.post(
-            f"optionSets/{OPTION_SET_UID}/options/{uid}",
-            params={"importStrategy": "CREATE_OR_UPDATE"},
+        # full report lists imported objects
+        report = call_with_retries(
+            lambda: dhis2.api.get(f"tracker/jobs/{job_uid}/report", params={"reportMode": "FULL"}),
+            f"Report request of import job {job_uid}",
+            max_retries,
+        )
+
+        report["job"] = job_uid
+        # failed jobs are rolled back: the chunk is only submitted again if the job failed
+        # for another reason than invalid objects
+        if report["status"] != "ERROR" or not is_retryable(report) or attempt == max_retries:
+            return report
+        current_run.log_warning(
+            f"Import job {job_uid} for {name} failed. Full report available at {dhis2.api.url}/tracker/jobs/{job_uid}/report"
         )
 
 
@@ -783,133 +922,96 @@ def post(
     import_mode: str,
     import_strategy: str,
     validation_mode: str,
-) -> bool:
-    """Push tracked entities, program enrollments or events to DHIS2."""
+    chunk_size: int = 5000,
+    max_jobs: int = 2,
+    timeout: float = JOB_TIMEOUT,
+) -> List[dict]:
+    """Push tracked entities, program enrollments or events to DHIS2.
+
+    The payload is split into chunks of `chunk_size` objects, imported as separate jobs
+    with at most `max_jobs` jobs running at the same time. Returns the job reports.
+    """
     params = {
         "importMode": import_mode,
         "importStrategy": import_strategy,
         "validationMode": validation_mode,
     }
     # check if payload is empty before starting import job
-    empty = True
-    for payload_type in ["events", "trackedEntities", "enrollments"]:
-        if payload.get(payload_type):
-            empty = False
-    if empty:
+    chunks = split_payload(payload, chunk_size)
+    if not chunks:
         current_run.log_info("No change detected, skipping import job")
-        return True
+        return []
 
-    # start import job
-    r = dhis2.api.post(
-        endpoint="tracker",
-        json=payload,
-        params=params,
-    )
-    job_uid = r.json()["response"]["id"]
-    current_run.log_info(
-        f"Started tracker import job {job_uid}. Waiting for completion..."
-    )
     current_run.log_info(
-        f"Import job progress available at {dhis2.api.url}/tracker/jobs/{job_uid}"
+        f"Importing payload in {len(chunks)} chunks of at most {chunk_size or 'unlimited'} objects"
     )
-
-    # request job status and wait for completion
-    completed = False
-    while not completed:
-        r = dhis2.api.get(f"tracker/jobs/{job_uid}")
-        progress = r
-        for task in progress:
-            if task.get("completed"):
-                completed = True
-        sleep(10)
+    reports = []
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        # objects of different types may reference each other: they are not imported
+        # at the same time
+        for payload_type in ["trackedEntities", "enrollments", "events"]:
+            futures = [
+                executor.submit(
+                    import_chunk,
+                    dhis2,
+                    chunk,
+                    params,
+                    name=f"chunk {i + 1}/{len(chunks)}",
+                    timeout=timeout,
+                )
+                for i, chunk in enumerate(chunks)
+                if payload_type in chunk
+            ]
+            reports += [future.result() for future in futures]
 
     # check job failure/success
-    r = dhis2.api.get(f"tracker/jobs/{job_uid}/report")
-    report = r
-    if report["status"] == "OK":
-        created = report["stats"]["created"]
-        updated = report["stats"]["updated"]
-        deleted = report["stats"]["deleted"]
-        ignored = report["stats"]["ignored"]
-        current_run.log_info(
-            f"Import job {job_uid} completed (created: {created}, updated: {updated}, deleted: {deleted}, ignored: {ignored})"
-        )
-        current_run.log_info(
-            f"Full report available at {dhis2.api.url}/tracker/jobs/{job_uid}/report"
-        )
-    else:
-        current_run.log_error(
-            f"Import job {job_uid} failed. Full report available at {dhis2.api.url}/tracker/jobs/{job_uid}/report"
-        )
-        raise ValueError(
-            f"Import job {job_uid} failed. Full report available at {dhis2.api.url}/tracker/jobs/{job_uid}/report"
-        )
+    failed = [report["job"] for report in reports if report["status"] != "OK"]
+    stats = {
+        key: sum(report.get("stats", {}).get(key, 0) for report in reports)
+        for key in ["created", "updated", "deleted", "ignored"]
+    }
+    if failed:
+        for job_uid in failed:
+            current_run.log_error(
+                f"Import job {job_uid} failed. Full report available at {dhis2.api.url}/tracker/jobs/{job_uid}/report"
+            )
+        raise ValueError(f"{len(failed)} of {len(reports)} import jobs failed")
 
-    return True
+    current_run.log_info(
+        f"Import completed in {len(reports)} jobs (created: {stats['created']}, updated: {stats['updated']}, deleted: {stats['deleted']}, ignored: {stats['ignored']})"
+    )
+    return reports
 
 
-@moodle_to_dhis2.task
-def sync(
-    import_mode: str,
-    import_strategy: str,
-    validation_mode: str,
-    input_dir: Path,
-    output_dir: Path,
-):
-    dhis2 = DHIS2(workspace.dhis2_connection("lifenet"))
+def apply_import(
+    state: pl.DataFrame,
+    objects: pl.DataFrame,
+    on: str,
+    reports: List[dict],
+    tracker_type: str,
+    fetch: Callable[[List[str]], pl.DataFrame],
+) -> pl.DataFrame:
+    """Update a local copy of DHIS2 data with the objects of an import payload.
 
-    # add missing course and module options to DHIS2 if needed
-    current_run.log_info("Checking course and module option sets in DHIS2")
-    courses = pl.read_parquet(input_dir / "courses.parquet")
-    add_missing_options(dhis2, courses)
-
-    # load and transform moodle users data
-    users = pl.read_parquet(input_dir / "users.parquet")
-    tracked_entities = get_tracked_entities(dhis2, TRACKED_ENTITY_TYPE)
-    users = transform_users(dhis2, users, tracked_entities)
-
-    # push users as tracked entities
-    payload = build_tracked_entities_payload(dhis2, users, tracked_entities)
-    current_run.log_info(f"Importing {len(payload)} tracked entities")
-    with open(output_dir / "tracked_entities.json", "w") as f:
-        json.dump(payload, f)
-    post(
-        dhis2,
-        payload={"trackedEntities": payload},
-        import_mode=import_mode,
-        import_strategy=import_strategy,
-        validation_mode=validation_mode,
-    )
+    Objects listed as imported in the job reports are applied from the payload. Other
+    objects (rejected, or missing from the reports) are fetched from DHIS2 by UID.
+    """
+    if objects.is_empty():
+        return state
 
-    # reload users with up-to-date trackedEntities uid
-    users = pl.read_parquet(input_dir / "users.parquet")
-    tracked_entities = get_tracked_entities(dhis2, TRACKED_ENTITY_TYPE)
-    users = transform_users(dhis2, users, tracked_entities)
-    users.write_parquet(output_dir / "users.parquet")
+    imported = objects[on].is_in(list(get_imported_uids(reports, tracker_type)))
+    state = update_state(state, objects.filter(imported), on)
 
-    # push program enrollments
-    enrollments = get_enrollments(dhis2, LEARNING_PROGRAM_UID)
-    payload = build_enrollments_payload(dhis2, users, enrollments, LEARNING_PROGRAM_UID)
-    current_run.log_info(f"Importing {len(payload)} program enrollments")
-    post(
-        dhis2,
-        payload={"enrollments": payload},
-        import_mode=import_mode,
-        import_strategy=import_strategy,
-        validation_mode=validation_mode,
-    )
-    with open(output_dir / "enrollments.json", "w") as f:
-        json.dump(payload, f)
+    unclear = objects.filter(~imported)[on].to_list()
+    if unclear:
+        current_run.log_info(f"Fetching {len(unclear)} objects with unclear import status")
+        state = update_state(state, fetch(unclear), on)
 
-    # reload program enrollments with up-to-date uid
-    enrollments = get_enrollments(dhis2, LEARNING_PROGRAM_UID)
+    return state
 
-    # load and transform moodle grades data
-    grades = pl.read_parquet(input_dir / "grades.parquet")
-    courses = pl.read_parquet(input_dir / "courses.parquet")
-    events = get_events(
-        dhis2, LEARNING_PROGRAM_UID, LEARNING_DATA_VALUES, include_deleted=False
-    )
+
+def format_learning_events(events: pl.DataFrame) -> pl.DataFrame:
+    """Set data types of existing grade events of the learning program."""
     # Ensure all expected data element columns exist with correct types
     for col in LEARNING_DATA_VALUES.keys():
         if col not in events.columns:
@@ -928,31 +1030,11 @@ def sync(
             pl.col("score").cast(float),
         ]
     )
-    grades = transform_grades(dhis2, grades, enrollments, tracked_entities, courses, events)
-    grades.write_parquet(output_dir / "grades.parquet")
-
-    # push moodle grades events
-    payload = build_grade_events_payload(dhis2, grades, events)
-    current_run.log_info(f"Importing {len(payload)} grades as events")
-    post(
-        dhis2,
-        payload={"events": payload},
-        import_mode=import_mode,
-        import_strategy=import_strategy,
-        validation_mode=validation_mode,
-    )
-    with open(output_dir / "events_grades.json", "w") as f:
-        json.dump(payload, f)
+    return events
 
-    # load and transform moodle course enrollments data
-    enrollments = pl.read_parquet(input_dir / "enrollments.parquet")
-    certificates = pl.read_parquet(input_dir / "certificates.parquet")
-    courses = pl.read_parquet(input_dir / "courses.parquet")
-    completions = pl.read_parquet(input_dir / "completions.parquet")
-    events = get_events(
-        dhis2, ENROLLMENTS_PROGRAM_UID, ENROLLMENTS_DATA_VALUES, include_deleted=False
-    )
 
+def format_course_enrollment_events(events: pl.DataFrame) -> pl.DataFrame:
+    """Set data types of existing course enrollment events."""
     # Ensure all expected data element columns exist with correct types
     for col in ENROLLMENTS_DATA_VALUES.keys():
         if col not in events.columns:
@@ -969,23 +1051,221 @@ def sync(
             (pl.col("certificate_issued") == "true").alias("certificate_issued"),
         ]
     )
-    enrollments = transform_enrollments(
-        dhis2, enrollments, users, certificates, courses, completions, events
-    )
-    enrollments.write_parquet(output_dir / "enrollments.parquet")
+    return events
 
-    # push moodle course enrollments events
-    payload = build_enrollment_events_payload(dhis2, enrollments, events)
-    current_run.log_info(f"Importing {len(payload)} course enrollments as events")
-    post(
-        dhis2,
-        payload={"events": payload},
-        import_mode=import_mode,
-        import_strategy=import_strategy,
-        validation_mode=validation_mode,
+
+@moodle_to_dhis2.task
+def sync(
+    import_mode: str,
+    import_strategy: str,
+    validation_mode: str,
+    chunk_size: int,
+    max_jobs: int,
+    full_refresh: bool,
+    local_uids: bool,
+    compress_payloads: bool,
+    input_dir: Path,
+    output_dir: Path,
+    cache_dir: Path,
+):
+    dhis2 = DHIS2(workspace.dhis2_connection("lifenet"))
+
+    # UIDs of new objects, shared by all stages
+    uids = UidPool(dhis2, local=local_uids)
+
+    courses = pl.read_parquet(input_dir / "courses.parquet")
+
+    # existing DHIS2 data is kept in a local cache, refreshed with data updated since
+    # the previous run
+    server_time = get_server_time(dhis2)
+
+    def cached(name: str, on: str, fetch: Callable[[str], pl.DataFrame]) -> pl.DataFrame:
+        return get_cached(
+            cache_dir,
+            name,
+            on=on,
+            fetch=fetch,
+            server_time=server_time,
+            full_refresh=full_refresh,
+        )
+
+    def fetch_events(program_uid: str, data_values: dict) -> pl.DataFrame:
+        return cached(
+            f"events_{program_uid}",
+            on="event",
+            fetch=lambda since: get_events(
+                dhis2,
+                program_uid,
+                data_values,
+                include_deleted=since is not None,
+                updated_after=since,
+            ),
+        )
+
+    def import_payload(payload_type: str, objects: List[dict], name: str) -> List[dict]:
+        # objects are encoded once, to be written to disk and sent to DHIS2
+        fname = f"{name}.json.gz" if compress_payloads else f"{name}.json"
+        encoded = write_payload(objects, output_dir / fname, compress=compress_payloads)
+        return post(
+            dhis2,
+            payload={payload_type: encoded},
+            import_mode=import_mode,
+            import_strategy=import_strategy,
+            validation_mode=validation_mode,
+            chunk_size=chunk_size,
+            max_jobs=max_jobs,
+        )
+
+    def add_options():
+        # add missing course and module options to DHIS2 if needed
+        current_run.log_info("Checking course and module option sets in DHIS2")
+        add_missing_options(dhis2, courses, uids=uids)
+
+    def import_tracked_entities(tracked_entities: pl.DataFrame):
+        # load and transform moodle users data
+        users = pl.read_parquet(input_dir / "users.parquet")
+        users = transform_users(dhis2, users, tracked_entities)
+
+        # push users as tracked entities
+        payload = build_tracked_entities_payload(dhis2, users, tracked_entities, uids=uids)
+        current_run.log_info(f"Importing {len(payload)} tracked entities")
+        reports = import_payload("trackedEntities", payload, "tracked_entities")
+        return payload, reports
+
+    def reload_users(tracked_entities: pl.DataFrame, imported: tuple):
+        # update tracked entities with imported ones to get up-to-date trackedEntities
+        # uid
+        payload, reports = imported
+        # nothing is imported in validation mode: the cached data is still up to date
+        if import_mode == "COMMIT":
+            tracked_entities = apply_import(
+                state=tracked_entities,
+                objects=format_tracked_entities(payload),
+                on="trackedEntity",
+                reports=reports,
+                tracker_type="TRACKED_ENTITY",
+                fetch=lambda uids: get_tracked_entities(dhis2, TRACKED_ENTITY_TYPE, uids=uids),
+            )
+        users = pl.read_parquet(input_dir / "users.parquet")
+        users = transform_users(dhis2, users, tracked_entities)
+        users.write_parquet(output_dir / "users.parquet")
+        return users, tracked_entities
+
+    def import_enrollments(users: tuple, enrollments: pl.DataFrame):
+        # push program enrollments
+        users, _ = users
+        payload = build_enrollments_payload(
+            dhis2, users, enrollments, LEARNING_PROGRAM_UID, uids=uids
+        )
+        current_run.log_info(f"Importing {len(payload)} program enrollments")
+        reports = import_payload("enrollments", payload, "enrollments")
+        return payload, reports
+
+    def reload_enrollments(enrollments: pl.DataFrame, imported: tuple):
+        # update program enrollments with imported ones to get up-to-date uid
+        payload, reports = imported
+        # nothing is imported in validation mode: the cached data is still up to date
+        if import_mode != "COMMIT":
+            return enrollments
+        return apply_import(
+            state=enrollments,
+            objects=pl.DataFrame(payload),
+            on="enrollment",
+            reports=reports,
+            tracker_type="ENROLLMENT",
+            fetch=lambda uids: get_enrollments(dhis2, LEARNING_PROGRAM_UID, uids=uids),
+        )
+
+    def prepare_grades(users: tuple, enrollments: pl.DataFrame, events: pl.DataFrame):
+        # load and transform moodle grades data
+        _, tracked_entities = users
+        grades = pl.read_parquet(input_dir / "grades.parquet")
+        grades = transform_grades(dhis2, grades, enrollments, tracked_entities, courses, events)
+        grades.write_parquet(output_dir / "grades.parquet")
+        return build_grade_events_payload(dhis2, grades, events, uids=uids)
+
+    def prepare_course_enrollments(users: tuple, events: pl.DataFrame):
+        # load and transform moodle course enrollments data
+        users, _ = users
+        enrollments = pl.read_parquet(input_dir / "enrollments.parquet")
+        certificates = pl.read_parquet(input_dir / "certificates.parquet")
+        completions = pl.read_parquet(input_dir / "completions.parquet")
+        enrollments = transform_enrollments(
+            dhis2, enrollments, users, certificates, courses, completions, events
+        )
+        enrollments.write_parquet(output_dir / "enrollments.parquet")
+        return build_enrollment_events_payload(dhis2, enrollments, events, uids=uids)
+
+    def import_grades(payload: List[dict], *_):
+        # push moodle grades events
+        current_run.log_info(f"Importing {len(payload)} grades as events")
+        import_payload("events", payload, "events_grades")
+
+    def import_course_enrollments(payload: List[dict], *_):
+        # push moodle course enrollments events
+        current_run.log_info(f"Importing {len(payload)} course enrollments as events")
+        import_payload("events", payload, "events_enrollments")
+
+    # existing DHIS2 data is fetched while the first imports are running. imports are
+    # started one after the other so that the number of concurrent import jobs stays
+    # below `max_jobs`.
+    run_stages(
+        {
+            "options": (add_options, []),
+            "tracked_entities": (
+                lambda: cached(
+                    "tracked_entities",
+                    on="trackedEntity",
+                    fetch=lambda since: get_tracked_entities(
+                        dhis2, TRACKED_ENTITY_TYPE, updated_after=since
+                    ),
+                ),
+                [],
+            ),
+            "enrollments": (
+                lambda: cached(
+                    f"enrollments_{LEARNING_PROGRAM_UID}",
+                    on="enrollment",
+                    fetch=lambda since: get_enrollments(
+                        dhis2, LEARNING_PROGRAM_UID, updated_after=since
+                    ),
+                ),
+                [],
+            ),
+            "learning_events": (
+                lambda: format_learning_events(
+                    fetch_events(LEARNING_PROGRAM_UID, LEARNING_DATA_VALUES)
+                ),
+                [],
+            ),
+            "course_enrollment_events": (
+                lambda: format_course_enrollment_events(
+                    fetch_events(ENROLLMENTS_PROGRAM_UID, ENROLLMENTS_DATA_VALUES)
+                ),
+                [],
+            ),
+            "import_tracked_entities": (import_tracked_entities, ["tracked_entities"]),
+            "users": (reload_users, ["tracked_entities", "import_tracked_entities"]),
+            "import_enrollments": (import_enrollments, ["users", "enrollments"]),
+            "reload_enrollments": (
+                reload_enrollments,
+                ["enrollments", "import_enrollments"],
+            ),
+            "grades": (
+                prepare_grades,
+                ["users", "reload_enrollments", "learning_events"],
+            ),
+            "course_enrollments": (
+                prepare_course_enrollments,
+                ["users", "course_enrollment_events"],
+            ),
+            "import_grades": (import_grades, ["grades", "options"]),
+            "import_course_enrollments": (
+                import_course_enrollments,
+                ["course_enrollments", "import_grades"],
+            ),
+        }
     )
-    with open(output_dir / "events_enrollments.json", "w") as f:
-        json.dump(payload, f)
 
     return
 
@@ -0,0 +1,53 @@
+"""Concurrent execution of dependent pipeline stages."""
+
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from threading import Event
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+from openhexa.sdk import current_run
+
+
+def run_stages(stages: Dict[str, Tuple[Callable, List[str]]]) -> Dict[str, object]:
+    """Run stages concurrently, each one as soon as its dependencies are completed.
+
+    Stages map names to a function and the names of the (previously declared) stages
+    whose results it takes as arguments. Returns the results by stage name. The first
+    error is raised, and stages that have not started yet are cancelled.
+    """
+    futures: Dict[str, Future] = {}
+    timings = {}
+    failed = Event()
+
+    def run(name: str, func: Callable, dependencies: List[str]):
+        args = [futures[dependency].result() for dependency in dependencies]
+        if failed.is_set():
+            raise CancelledError(f"Stage {name} cancelled")
+        start = perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            failed.set()
+            raise
+        timings[name] = perf_counter() - start
+        current_run.log_info(f"Stage {name} completed in {timings[name]:.1f}s")
+        return result
+
+    # stages wait for their dependencies in their own thread: one thread per stage
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        for name, (func, dependencies) in stages.items():
+            for dependency in dependencies:
+                if dependency not in futures:
+                    raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+            futures[name] = executor.submit(run, name, func, dependencies)
+
+    for future in futures.values():
+        error = future.exception()
+        if error is not None and not isinstance(error, CancelledError):
+            raise error
+
+    current_run.log_info(
+        "Stage timings: "
+        + ", ".join(f"{name} {duration:.1f}s" for name, duration in timings.items())
+    )
+    return {name: future.result() for name, future in futures.items()}
@@ -1,5 +1,10 @@
-from time import sleep
-from typing import List
+import secrets
+import string
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterable, List
 
 import polars as pl
 from openhexa.sdk import current_run
@@ -8,6 +13,8 @@ from openhexa.toolbox.dhis2 import DHIS2
 DHIS2_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%3f"
 STORED_BY = "Bluesquare"
 
+UID_CHARACTERS = string.ascii_letters + string.digits
+
 LEARNING_PROGRAM_UID = "NYY8hzVYv8f"
 LEARNING_PROGRAM_STAGE_UID = "iW8k954zTRK"
 
@@ -16,6 +23,9 @@ ENROLLMENTS_PROGRAM_STAGE_UID = "mHBassGTx51"
 
 TRACKED_ENTITY_TYPE = "ZDSBUOcHKV2"
 
+# maximum duration of a tracker import job (seconds)
+JOB_TIMEOUT = 3600
+
 TRACKED_ENTITY_ATTRIBUTES = {
     "first_name": "BHg8LLaoolq",
     "last_name": "srPxZ5neKN8",
@@ -67,6 +77,8 @@ ENROLLMENTS_DATA_VALUES = {
     "completion_status": "ZYRGnmPtQZl",
 }
 
+DATA_VALUES_DTYPE = pl.List(pl.Struct({"dataElement": pl.Utf8, "value": pl.Utf8}))
+
 LEARNING_DATA_VALUES = {
     "completion_status": "ZYRGnmPtQZl",
     "course_id": "cLaBzltcQ8f",
@@ -77,34 +89,22 @@ LEARNING_DATA_VALUES = {
 }
 
 
-def get_tracked_entities(dhis2: DHIS2, tracked_entity_type: str) -> pl.DataFrame:
-    """Get all tracked entities from DHIS2 for a given tracked entity type."""
+def format_tracked_entities(entities: List[dict]) -> pl.DataFrame:
+    """Convert tracked entities from the DHIS2 API into a dataframe.
+
+    Attributes are converted into columns, named after `TRACKED_ENTITY_ATTRIBUTES`.
+    """
     mapping = {v: k for k, v in TRACKED_ENTITY_ATTRIBUTES.items()}
-    entities = []
 
-    r = dhis2.api.get(
-        "tracker/trackedEntities",
-        params={
-            "ouMode": "ALL",
-            "trackedEntityType": tracked_entity_type,
-            "filter": f"{TRACKED_ENTITY_ATTRIBUTES['user_id']}:gt:0",
-            "fields": "trackedEntity,trackedEntityType,createdAt,updatedAt,orgUnit,inactive,deleted,programOwners,attributes[attribute,value]",
-            "paging": False,
-        },
-    )
-    transfered = 0
-    for entity in r["trackedEntities"]:
-        if "programOwners" in entity and entity["programOwners"]:
-            transfered += 1
-            
-        for attr in entity["attributes"]:
+    rows = []
+    for entity in entities:
+        row = {k: v for k, v in entity.items() if k != "attributes"}
+        for attr in entity.get("attributes") or []:
             key = mapping.get(attr["attribute"])
             if key is not None:
-                entity[key] = attr["value"]
-        entities.append(entity)
-        
-    current_run.log_info(f"Fetched {len(entities)} tracked entities from DHIS2 ({transfered} with program ownership updates)")
-    
+                row[key] = attr["value"]
+        rows.append(row)
+
     COLUMNS = [
         "trackedEntity",
         "trackedEntityType",
@@ -117,7 +117,7 @@ def get_tracked_entities(dhis2: DHIS2, tracked_entity_type: str) -> pl.DataFrame
     ]
     COLUMNS += list(mapping.values())
 
-    df = pl.DataFrame(entities)
+    df = pl.DataFrame(rows)
 
     if df.is_empty():
         return df
@@ -126,31 +126,131 @@ def get_tracked_entities(dhis2: DHIS2, tracked_entity_type: str) -> pl.DataFrame
 
     df = df.with_columns(
         [
-            pl.col("createdAt").str.to_datetime(format=DHIS2_DATE_FORMAT),
-            pl.col("updatedAt").str.to_datetime(format=DHIS2_DATE_FORMAT),
-            pl.col("user_id").cast(int),
+            pl.col(c).str.to_datetime(format=DHIS2_DATE_FORMAT)
+            for c in ["createdAt", "updatedAt"]
+            if c in df.columns
         ]
+        + [pl.col("user_id").cast(int)]
     )
 
     return df
 
 
-def get_enrollments(dhis2: DHIS2, program_uid: str) -> pl.DataFrame:
-    """Get existing enrollments for a given Tracker program."""
-    enrollments = []
+def get_tracked_entities(
+    dhis2: DHIS2,
+    tracked_entity_type: str,
+    uids: List[str] = None,
+    updated_after: str = None,
+) -> pl.DataFrame:
+    """Get all tracked entities from DHIS2 for a given tracked entity type.
+
+    If `uids` is provided, only these tracked entities are requested. If
+    `updated_after` is provided, only tracked entities updated or deleted since then
+    are requested.
+    """
+    params = {
+        "ouMode": "ALL",
+        "trackedEntityType": tracked_entity_type,
+        "filter": f"{TRACKED_ENTITY_ATTRIBUTES['user_id']}:gt:0",
+        "fields": "trackedEntity,trackedEntityType,createdAt,updatedAt,orgUnit,inactive,deleted,programOwners,attributes[attribute,value]",
+        "paging": False,
+    }
+    if updated_after:
+        params["updatedAfter"] = updated_after
+        params["includeDeleted"] = True
 
-    r = dhis2.api.get(
-        "tracker/enrollments",
-        params={"ouMode": "ALL", "program": program_uid, "paging": False},
-    )
+    entities = []
+    for batch in split_uids(uids):
+        if batch:
+            params["trackedEntities"] = ";".join(batch)
+        r = dhis2.api.get("tracker/trackedEntities", params=params)
+        entities += r["trackedEntities"]
+
+    transfered = len([e for e in entities if e.get("programOwners")])
+    current_run.log_info(f"Fetched {len(entities)} tracked entities from DHIS2 ({transfered} with program ownership updates)")
+
+    return format_tracked_entities(entities)
 
-    for enrol in r["enrollments"]:
-        enrollments.append(enrol)
+
+def get_enrollments(
+    dhis2: DHIS2,
+    program_uid: str,
+    uids: List[str] = None,
+    updated_after: str = None,
+) -> pl.DataFrame:
+    """Get existing enrollments for a given Tracker program.
+
+    If `uids` is provided, only these enrollments are requested. If `updated_after` is
+    provided, only enrollments updated or deleted since then are requested.
+    """
+    enrollments = []
+    params = {
+        "ouMode": "ALL",
+        "program": program_uid,
+        "fields": "enrollment,trackedEntity,program,status,orgUnit,enrolledAt,occurredAt,createdAt,updatedAt,deleted",
+        "paging": False,
+    }
+    if updated_after:
+        params["updatedAfter"] = updated_after
+        params["includeDeleted"] = True
+
+    for batch in split_uids(uids):
+        if batch:
+            params["enrollments"] = ";".join(batch)
+        r = dhis2.api.get("tracker/enrollments", params=params)
+        enrollments += r["enrollments"]
 
     df = pl.DataFrame(enrollments)
     return df
 
 
+def split_uids(uids: List[str] = None, batch_size: int = 100) -> List[List[str]]:
+    """Split UIDs into batches short enough to be used as a request parameter.
+
+    Returns a single empty batch if no UIDs are provided.
+    """
+    if uids is None:
+        return [[]]
+    return [uids[i : i + batch_size] for i in range(0, len(uids), batch_size)]
+
+
+def get_imported_uids(reports: List[dict], tracker_type: str) -> set:
+    """Get UIDs of objects (TRACKED_ENTITY, ENROLLMENT, EVENT) created or updated by
+    tracker import jobs.
+
+    Objects are only listed in reports requested with `reportMode=FULL`.
+    """
+    uids = set()
+    for report in reports:
+        if report.get("status") != "OK":
+            continue
+        type_reports = (report.get("bundleReport") or {}).get("typeReportMap") or {}
+        for object_report in (type_reports.get(tracker_type) or {}).get("objectReports") or []:
+            if not object_report.get("errorReports"):
+                uids.add(object_report["uid"])
+    return uids
+
+
+def flatten_data_values(events: pl.DataFrame, mapping: dict) -> pl.DataFrame:
+    """Replace the `dataValues` column of events with one string column per data element.
+
+    `mapping` gives column names by data element UID. Other data elements are ignored.
+    """
+    values = (
+        events.select(["event", "dataValues"])
+        .explode("dataValues")
+        .unnest("dataValues")
+        .filter(pl.col("dataElement").is_in(list(mapping)))
+    )
+    values = values.group_by("event").agg(
+        [
+            pl.col("value").filter(pl.col("dataElement") == uid).first().alias(column)
+            for uid, column in mapping.items()
+        ]
+    )
+    return events.drop("dataValues").join(other=values, on="event", how="left")
+
+
 def get_events(
     dhis2: DHIS2, 
     program_uid: str, 
@@ -158,11 +258,16 @@ def get_events(
     include_deleted: bool = False,
     page_size: int = 5000,
     max_retries: int = 3,
-    retry_delay: int = 2
+    retry_delay: int = 2,
+    updated_after: str = None,
+    max_workers: int = 4,
 ) -> pl.DataFrame:
-    """Get existing enrollments for a given Tracker program using pagination to prevent timeouts."""
-    events = []
+    """Get existing enrollments for a given Tracker program using pagination to prevent timeouts.
 
+    Up to `max_workers` pages are fetched at the same time. Each page is converted to
+    a dataframe as soon as it is received. If `updated_after` is provided, only events
+    updated since then are requested.
+    """
     mapping = {v: k for k, v in data_values.items()}
 
     BASE_COLUMNS = {
@@ -182,6 +287,7 @@ def get_events(
         "attributeCategoryOptions": pl.Utf8,
     }
     SCHEMA = {**BASE_COLUMNS, **{col: pl.Utf8 for col in mapping.values()}}
+    PAGE_SCHEMA = {**BASE_COLUMNS, "dataValues": DATA_VALUES_DTYPE}
 
     def make_request_with_retry(params, retry_count=0):
         """Make API request with automatic retry on failure."""
@@ -195,7 +301,30 @@ def get_events(
                 return make_request_with_retry(params, retry_count + 1)
             else:
                 raise e
-    
+
+    def fetch_page(page: int) -> pl.DataFrame:
+        """Fetch a page of events as a dataframe."""
+        params = {
+            "ouMode": "ALL",
+            "program": program_uid,
+            "includeDeleted": include_deleted,
+            "page": page,
+            "pageSize": page_size,
+            "totalPages": False,
+            "order": "createdAt:asc",  # Consistent ordering to avoid duplicates
+        }
+        if updated_after:
+            params["updatedAfter"] = updated_after
+
+        try:
+            r = make_request_with_retry(params)
+        except Exception as e:
+            current_run.log_error(f"Failed to fetch page {page} after {max_retries} retries: {str(e)}")
+            raise
+
+        events = pl.from_dicts(r.get("events") or [], schema=PAGE_SCHEMA)
+        return flatten_data_values(events, mapping).select(list(SCHEMA))
+
     try:
         # First, get total count to determine number of pages
         params = {
@@ -206,6 +335,8 @@ def get_events(
             "pageSize": 1,  # Just get one result to check total
             "totalPages": True,
         }
+        if updated_after:
+            params["updatedAfter"] = updated_after
         
         r = make_request_with_retry(params)
         pager = r.get("pager", {})
@@ -220,60 +351,41 @@ def get_events(
         
         current_run.log_info(f"Found {total_instances} total events across {total_pages} pages")
         
-        # Fetch all pages with pagination
-        for page in range(1, total_pages + 1):
-            params = {
-                "ouMode": "ALL",
-                "program": program_uid,
-                "includeDeleted": include_deleted,
-                "page": page,
-                "pageSize": page_size,
-                "totalPages": True,
-                "order": "createdAt:asc",  # Consistent ordering to avoid duplicates
-            }
-            
-            try:
-                r = make_request_with_retry(params)
-                
-                if "events" in r and r["events"]:
-                    for event in r["events"]:
-                        if "dataValues" in event:
-                            for data_value in event["dataValues"]:
-                                key = mapping.get(data_value["dataElement"])
-                                if key is not None:
-                                    event[key] = data_value["value"]
-                        events.append(event)
-                    
-                    current_run.log_info(f"Fetched page {page}/{total_pages}: {len(r['events'])} events (Total: {len(events)})")
-                
-                # Update total_pages in case the underlying count changes between requests
-                page_count = r.get("pager", {}).get("pageCount", r.get("totalPages"))
-                if page_count is not None and page_count != total_pages:
-                    total_pages = page_count
-                    current_run.log_info(f"Total pages updated to: {total_pages}")
-                
-                # Small delay between requests to avoid rate limiting
-                if page < total_pages:
-                    sleep(0.1)
-                    
-            except Exception as e:
-                current_run.log_error(f"Failed to fetch page {page} after {max_retries} retries: {str(e)}")
-                raise
-        
-        current_run.log_info(f"Successfully fetched {len(events)} total events")
+        # Fetch all pages with pagination, several pages at a time
+        batches = []
+        fetched = 0
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            for page, batch in enumerate(executor.map(fetch_page, range(1, total_pages + 1)), start=1):
+                batches.append(batch)
+                fetched += len(batch)
+                current_run.log_info(f"Fetched page {page}/{total_pages}: {len(batch)} events (Total: {fetched})")
+
+        # events created since the count request are on additional pages
+        page = total_pages
+        while len(batches[-1]) == page_size:
+            page += 1
+            batches.append(fetch_page(page))
+            fetched += len(batches[-1])
+            current_run.log_info(f"Fetched additional page {page}: {len(batches[-1])} events (Total: {fetched})")
+
+        current_run.log_info(f"Successfully fetched {fetched} total events")
         
     except Exception as e:
         current_run.log_error(f"Error fetching events: {str(e)}")
         raise
-    
-    if events:
-        df = pl.DataFrame(events)
-        df = df.select([c for c in SCHEMA if c in df.columns])
-    else:
-        df = pl.DataFrame(schema=SCHEMA)
+
+    # pages may overlap if events are created while they are fetched
+    df = pl.concat(batches, how="vertical")
+    df = df.unique(subset="event", keep="first", maintain_order=True)
 
     return df
 
+def get_server_time(dhis2: DHIS2) -> datetime:
+    """Get the current date and time of the DHIS2 server."""
+    r = dhis2.api.get("system/info")
+    return datetime.fromisoformat(r["serverDate"])
+
+
 def get_program_org_units(dhis2: DHIS2, program_uid: str) -> List[str]:
     """Get org units for a given DHIS2 Tracker program."""
     r = dhis2.api.get(f"programs/{program_uid}")
@@ -290,6 +402,56 @@ def generate_uid(dhis2: DHIS2, n: int = 1, batch_size: int = 10000) -> List[str]
     return uids
 
 
+def generate_local_uid() -> str:
+    """Generate valid UID locally.
+
+    As in DHIS2, UIDs are made of 11 random alphanumeric characters, starting with a
+    letter.
+    """
+    return secrets.choice(string.ascii_letters) + "".join(
+        secrets.choice(UID_CHARACTERS) for _ in range(10)
+    )
+
+
+class UidPool:
+    """Pool of UIDs for new DHIS2 objects, generated only when needed.
+
+    UIDs are either generated locally or requested from the DHIS2 API in batches of
+    increasing size, up to `max_batch_size`. UIDs already in use are never returned.
+    """
+
+    def __init__(self, dhis2: DHIS2, local: bool = False, max_batch_size: int = 10000):
+        self.dhis2 = dhis2
+        self.local = local
+        self.max_batch_size = max_batch_size
+        self.batch_size = 10
+        self.uids = []
+        self.used = set()
+        self.lock = Lock()
+
+    def exclude(self, uids: Iterable[str]):
+        """Mark UIDs as already in use, e.g. UIDs of existing objects."""
+        with self.lock:
+            self.used.update(uid for uid in uids if uid)
+
+    def pop(self) -> str:
+        """Get an unused UID."""
+        with self.lock:
+            while True:
+                if not self.uids:
+                    if self.local:
+                        self.uids.append(generate_local_uid())
+                    else:
+                        self.uids = generate_uid(self.dhis2, n=self.batch_size)
+                        self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+                uid = self.uids.pop()
+                if uid in self.used:
+                    current_run.log_warning(f"Discarding generated UID {uid} already in use")
+                    continue
+                self.used.add(uid)
+                return uid
+
+
 def join_tracked_entities_uid(
     dhis2: DHIS2, users: pl.DataFrame, tracked_entities: pl.DataFrame, program_uid: str
 ) -> pl.DataFrame:
@@ -327,7 +489,7 @@ def prepare_tracked_entities_payload(
 ) -> List[dict]:
     """Prepare JSON payload for DHIS2 Tracker tracked entities."""
     # generate valid DHIS2 uids, we will need len(users) at most
-    uids = generate_uid(dhis2, n=len(users))
+    uids = UidPool(dhis2)
 
     entities = []
 
@@ -365,7 +527,7 @@ def prepare_enrollments_payload(
 ) -> List[dict]:
     """Prepare JSON payload DHIS2 Tracker enrollments."""
     enrollments = []
-    uids = generate_uid(dhis2, n=len(users))
+    uids = UidPool(dhis2)
 
     for user in users.iter_rows(named=True):
         if not user.get("trackedEntity") or not user.get("org_unit"):
@@ -410,7 +572,7 @@ def prepare_grade_events_payload(
     data_values_mapping: dict,
 ):
     payload = []
-    uids = generate_uid(dhis2, n=len(grades))
+    uids = UidPool(dhis2)
 
     # join existing events uid
     events = get_events(
@@ -490,7 +652,7 @@ def prepare_course_enrollments_events_payload(
     program_stage_uid: str,
 ):
     payload = []
-    uids = generate_uid(dhis2, n=len(enrollments))
+    uids = UidPool(dhis2)
 
     # join user data
     enrollments = enrollments.join(other=users, on="user_id", how="left").join(
@@ -520,18 +682,15 @@ def prepare_course_enrollments_events_payload(
         )
 
     # certificate issued?
-    enrollments = enrollments.with_columns(
-        pl.struct(["user_id", "course_id"])
-        .map_elements(
-            lambda x: (
-                not certificates.filter(
-                    (pl.col("user_id") == x["user_id"])
-                    & (pl.col("course_id") == x["course_id"])
-                ).is_empty()
-            )
-        )
-        .alias("certificate_issued")
+    certified = (
+        certificates.select(["user_id", "course_id"])
+        .unique()
+        .cast({c: enrollments.schema[c] for c in ["user_id", "course_id"]})
+        .with_columns(pl.lit(True).alias("certificate_issued"))
     )
+    enrollments = enrollments.join(
+        other=certified, on=["user_id", "course_id"], how="left"
+    ).with_columns(pl.col("certificate_issued").fill_null(False))
 
     for enrol in enrollments.iter_rows(named=True):
         if not enrol.get("trackedEntity") or not enrol.get("org_unit"):
@@ -567,6 +726,43 @@ def prepare_course_enrollments_events_payload(
     return payload
 
 
+def wait_for_job(
+    dhis2: DHIS2,
+    job_uid: str,
+    timeout: float = JOB_TIMEOUT,
+    on_progress: Callable[[str], None] = None,
+    min_delay: float = 0.5,
+    max_delay: float = 30,
+) -> List[dict]:
+    """Wait for completion of a tracker import job and return its notifications.
+
+    The job status is polled with an exponential backoff, from `min_delay` to
+    `max_delay` seconds. Raises TimeoutError if the job is not completed in time.
+    """
+    deadline = monotonic() + timeout
+    delay = min_delay
+    messages = set()
+
+    while True:
+        steps = dhis2.api.get(f"tracker/jobs/{job_uid}")
+        completed = False
+        for step in steps:
+            message = step.get("message")
+            if on_progress and message and message not in messages:
+                on_progress(message)
+            messages.add(message)
+            if step.get("completed"):
+                completed = True
+        if completed:
+            return steps
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Import job {job_uid} not completed after {timeout}s")
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
 def post(dhis2: DHIS2, payload: dict) -> dict:
     """Push tracked entities, program enrollments or events to DHIS2."""
     for key in payload:
@@ -588,29 +784,8 @@ def post(dhis2: DHIS2, payload: dict) -> dict:
     r.raise_for_status()
     job = r.json()["response"]["id"]
 
-    completed = False
     current_run.log_info(f"Waiting for completion of DHIS2 Tracker import job {job}")
-    messages = []
-
-    i = 0
-    while not completed:
-        r = dhis2.api.get(endpoint=f"tracker/jobs/{job}")
-        for step in r:
-            if step["message"] not in messages:
-                messages.append(step["message"])
-                current_run.log_info(step["message"])
-            if step["completed"]:
-                completed = True
-
-        # wait 1 mn max
-        if i > 10:
-            sleep(60)
-        elif i > 5:
-            sleep(30)
-        else:
-            sleep(3)
-
-        i += 1
+    wait_for_job(dhis2, job, on_progress=current_run.log_info)
 
     # collect import report when job is done
     r = dhis2.api.get(endpoint=f"tracker/jobs/{job}/report")
@@ -654,30 +829,10 @@ def push_to_tracker(
 
     # regularly fetch import job status
 
-    completed = False
     current_run.log_info(
         f"Waiting for completion of DHIS2 Tracker import job {job_uid}"
     )
-    messages = []
-
-    i = 0
-    while not completed:
-        r = dhis2.api.get(endpoint=f"tracker/jobs/{job_uid}")
-        for step in r:
-            if step["message"] not in messages:
-                messages.append(step["message"])
-                current_run.log_info(step["message"])
-            if step["completed"]:
-                completed = True
-
-        if i > 10:
-            sleep(60)
-        elif i > 5:
-            sleep(30)
-        else:
-            sleep(3)
-
-        i += 1
+    wait_for_job(dhis2, job_uid, on_progress=current_run.log_info)
 
     # collect import report when job is done
 